@@ -1,58 +1,500 @@
 import socket
 import random
-from ipaddress import ip_address, IPv4Address
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_address
 import csv
 import json
 import math
+import gc
+import signal
+import threading
+import itertools
+import bisect
+import operator
+from collections import OrderedDict
+import sys
+import time
+
+from snapshot import write_snapshot_file
+from storage import (JournalStorage, MemoryStorage, SQLiteStorage, read_csv_file,
+                     read_cohort_number, typed_row, valid_customer,
+                     write_cohort_number, write_customers_file)
+from stats import Stats
+from profiling import Profiler
+import wire
+
+# load the database of a storage backend (see storage.py) and redo the
+# records it hands back on top of it.
+# returns the customers and the cohort number
+def load_database(storage):
+    # the records live as long as the bank, running the garbage collector
+    # while millions of them are created only costs time
+    gc.disable()
+    try:
+        rows, cohort_number, redo = storage.load()
+        records = list(itertools.starmap(CustomerRecord, rows))
+        del rows
+        customers = CustomerRegistry(records)
+    finally:
+        gc.enable()
+    # and keep later collections from scanning them again
+    gc.freeze()
+
+    for record in redo:
+        if record[0] == "next":
+            cohort_number = record[1]
+        else:
+            customers.apply(record)
+    customers.take_changes()
+
+    return customers, cohort_number
+
+
+# a customer of the bank
+# typed fields in __slots__ instead of the csv row of six strings: no per
+# instance dict, balance and cohort are ints, and hosts and ports are shared
+# objects (interned strings, the ints of snapshot.PORTS) rather than one
+# copy per customer
+class CustomerRecord:
+
+    __slots__ = ("name", "balance", "ipv4", "port1", "port2", "cohort")
+
+    def __init__(self, name, balance, ipv4, port1, port2, cohort=0):
+        self.name = name
+        self.balance = balance
+        self.ipv4 = ipv4
+        self.port1 = port1
+        self.port2 = port2
+        self.cohort = cohort
+
+    # parse a row in the customers.csv layout, the cohort is optional
+    @classmethod
+    def from_row(cls, row):
+        return cls(*typed_row(row))
+
+    # the fields in the customers.csv layout, as they are sent to the clients
+    def row(self):
+        return [self.name, str(self.balance), self.ipv4,
+                str(self.port1), str(self.port2), self.cohort]
+
+    # the typed fields, as a copy that does not follow later changes
+    def fields(self):
+        return (self.name, self.balance, self.ipv4, self.port1, self.port2, self.cohort)
+
+    # csv writers take a record as a row
+    def __iter__(self):
+        return iter(self.row())
+
+
+# pool of the customers without a cohort
+# records are kept in an array with a name -> position index, removal swaps
+# the record with the last one, so adding, removing and drawing k random
+# customers without replacement all take O(1) per customer
+class CustomerPool:
+
+    def __init__(self, customers=()):
+        self.customers = list(customers)
+        self.positions = {c.name: i for i, c in enumerate(self.customers)}
+
+    def __len__(self):
+        return len(self.customers)
+
+    def __iter__(self):
+        return iter(self.customers)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def add(self, c):
+        self.positions[c.name] = len(self.customers)
+        self.customers.append(c)
+
+    def remove(self, name):
+        self._swap(self.positions[name], len(self.customers) - 1)
+        del self.positions[name]
+        self.customers.pop()
+
+    # k distinct random customers, never the excluded one.
+    # the picked customers stay in the pool
+    def sample(self, k, exclude=None):
+        size = len(self.customers)
+        if exclude in self.positions:
+            # move it out of the range that is drawn from
+            self._swap(self.positions[exclude], size - 1)
+            size -= 1
+        if k > size:
+            raise ValueError("sample larger than the pool")
+
+        # partial Fisher-Yates shuffle of the end of the array
+        picked = []
+        for i in range(k):
+            end = size - 1 - i
+            self._swap(random.randint(0, end), end)
+            picked.append(self.customers[end])
+        return picked
+
+    def _swap(self, i, j):
+        customers = self.customers
+        customers[i], customers[j] = customers[j], customers[i]
+        self.positions[customers[i].name] = i
+        self.positions[customers[j].name] = j
+
+
+# key the customers are ordered by in a BalanceIndex
+balance_key = operator.attrgetter("balance", "name")
+
+
+# customers ordered by balance, then name
+# one sorted list would cost O(n) moves per insertion, so the records are
+# kept in sorted chunks of CHUNK to 2 * CHUNK records, with the key of the
+# first record of every chunk aside: adding or removing a record bisects
+# the chunks, then its chunk, and moves at most 2 * CHUNK references
+class BalanceIndex:
+
+    CHUNK = 2048
+
+    def __init__(self, customers=()):
+        ordered = sorted(customers, key=balance_key)
+        self.chunks = [ordered[i:i + self.CHUNK] for i in range(0, len(ordered), self.CHUNK)]
+        self.firsts = [balance_key(chunk[0]) for chunk in self.chunks]
+        self.length = len(ordered)
+
+    def __len__(self):
+        return self.length
+
+    # index of the chunk a key falls into
+    def _chunk(self, key):
+        return max(bisect.bisect_right(self.firsts, key) - 1, 0)
+
+    def add(self, c):
+        self.length += 1
+        key = balance_key(c)
+        if not self.chunks:
+            self.chunks.append([c])
+            self.firsts.append(key)
+            return
+
+        i = self._chunk(key)
+        chunk = self.chunks[i]
+        bisect.insort(chunk, c, key=balance_key)
+        self.firsts[i] = balance_key(chunk[0])
+        if len(chunk) > 2 * self.CHUNK:
+            self.chunks.insert(i + 1, chunk[self.CHUNK:])
+            self.firsts.insert(i + 1, balance_key(chunk[self.CHUNK]))
+            del chunk[self.CHUNK:]
+
+    def remove(self, c):
+        self.length -= 1
+        key = balance_key(c)
+        i = self._chunk(key)
+        chunk = self.chunks[i]
+        del chunk[bisect.bisect_left(chunk, key, key=balance_key)]
+        if chunk:
+            self.firsts[i] = balance_key(chunk[0])
+        else:
+            del self.chunks[i]
+            del self.firsts[i]
+
+    # the number of records from the given key on, and at most count of
+    # them, skipping the first ones. walks the chunks from the key's on
+    def from_key(self, key, first, count):
+        if not self.chunks:
+            return 0, []
+        i = self._chunk(key)
+        j = bisect.bisect_left(self.chunks[i], key, key=balance_key)
+        # counted from the nearer end
+        if i < len(self.chunks) // 2:
+            total = self.length - sum(map(len, self.chunks[:i])) - j
+        else:
+            total = sum(map(len, self.chunks[i:])) - j
+
+        records = []
+        first += j
+        for chunk in itertools.islice(self.chunks, i, None):
+            if first >= len(chunk):
+                first -= len(chunk)
+                continue
+            records.extend(chunk[first:first + count - len(records)])
+            first = 0
+            if len(records) == count:
+                break
+        return total, records
+
+
+# in-memory customer database of CustomerRecords
+# a cohort of 0 means "not in a cohort".
+# besides the name lookup, the registry keeps a cohort number -> members
+# index, the set of customers without a cohort, a host -> customers index
+# and the customers ordered by balance, and updates all of them on every
+# mutation so that commands and queries never scan the whole database
+class CustomerRegistry:
+
+    def __init__(self, customers=()):
+        # loaded customers are already persisted, they are not journaled.
+        # the indexes are built in bulk, this runs for every customer at startup
+        self.by_name = {c.name: c for c in customers}
+        self.unassigned = CustomerPool(
+            [c for c in self.by_name.values() if c.cohort == 0])   # customers with cohort 0
+
+        self.cohorts = {}       # cohort number -> {name: record}
+        self.hosts = {}         # ipv4 -> {name: record}
+        for c in self.by_name.values():
+            if c.cohort != 0:
+                self.cohorts.setdefault(c.cohort, {})[c.name] = c
+            self.hosts.setdefault(c.ipv4, {})[c.name] = c
+        self.balances = BalanceIndex(self.by_name.values())
+
+        # journal records of the mutations since the last take_changes()
+        self.changes = []
+
+        # told about every change of a cohort's members, see CohortCache
+        self.cohort_cache = None
+
+    def __len__(self):
+        return len(self.by_name)
+
+    # iterate over the customers in registration order, as they are written to csv
+    def __iter__(self):
+        return iter(self.by_name.values())
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def add(self, c):
+        self.by_name[c.name] = c
+        self._index(c)
+        self.hosts.setdefault(c.ipv4, {})[c.name] = c
+        self.balances.add(c)
+        self.changes.append(["put", c.row()])
+
+    def remove(self, name):
+        c = self.by_name.pop(name)
+        self._unindex(c)
+        host = self.hosts[c.ipv4]
+        del host[c.name]
+        if not host:
+            del self.hosts[c.ipv4]
+        self.balances.remove(c)
+        self.changes.append(["del", name])
+        return c
+
+    # move a customer into the given cohort (0 to leave its cohort)
+    def assign(self, c, cohort):
+        self._unindex(c)
+        c.cohort = cohort
+        self._index(c)
+        self.changes.append(["cohort", cohort, [c.name]])
+
+    # move several customers into the same cohort, as a single journal record
+    def assign_all(self, customers, cohort):
+        for c in customers:
+            self._unindex(c)
+            c.cohort = cohort
+            self._index(c)
+        self.changes.append(["cohort", cohort, [c.name for c in customers]])
+
+    # all customers sharing the given (non-zero) cohort number
+    def members(self, cohort):
+        return list(self.cohorts.get(cohort, {}).values())
+
+    # the customers matching a query on one of the indexes, from the
+    # first-th match on and at most count of them, and the number of matches.
+    # the index is "cohort" (value: a cohort number), "host" (an ipv4),
+    # "unassigned" (no value) or "balance-above" (an amount, exclusive).
+    # matches are in index order: registration order within a cohort or a
+    # host, pool order for "unassigned", which moves as customers are
+    # drawn, and balance then name for "balance-above"
+    def query(self, index, value, first, count):
+        if index == "cohort" and value != 0:
+            group = self.cohorts.get(value, {})
+            return len(group), list(itertools.islice(group.values(), first, first + count))
+        if index == "host":
+            group = self.hosts.get(value, {})
+            return len(group), list(itertools.islice(group.values(), first, first + count))
+        if index in ("cohort", "unassigned"):
+            return len(self.unassigned), self.unassigned.customers[first:first + count]
+        if index == "balance-above":
+            return self.balances.from_key((value + 1,), first, count)
+        raise ValueError(f"unknown index {index}")
+
+    # reset every member of a cohort back to cohort 0, returns the members
+    def dissolve(self, cohort):
+        members = list(self.cohorts.pop(cohort, {}).values())
+        self._changed(cohort)
+        for c in members:
+            c.cohort = 0
+            self.unassigned.add(c)
+        self.changes.append(["cohort", 0, [c.name for c in members]])
+        return members
+
+    # return and forget the journal records of the latest mutations
+    def take_changes(self):
+        changes, self.changes = self.changes, []
+        return changes
+
+    # redo a journal record written by one of the mutations above
+    def apply(self, record):
+        if record[0] == "put":
+            c = CustomerRecord.from_row(record[1])
+            if c.name in self.by_name:
+                self.remove(c.name)
+            self.add(c)
+        elif record[0] == "del":
+            if record[1] in self.by_name:
+                self.remove(record[1])
+        elif record[0] == "cohort":
+            for name in record[2]:
+                if name in self.by_name:
+                    self.assign(self.by_name[name], record[1])
+
+    # the host and balance indexes do not depend on the cohort, assign()
+    # and dissolve() leave them alone
+    def _index(self, c):
+        if c.cohort == 0:
+            self.unassigned.add(c)
+        else:
+            self.cohorts.setdefault(c.cohort, {})[c.name] = c
+            self._changed(c.cohort)
 
-# open a new csv file, acting as a database
-
-
-def read_csv_file(filepath):
-    data = []
-
-    with open(filepath) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        line_count = 0
-        for row in csv_reader:
-            if line_count == 0:
-                line_count += 1
-            else:
-                data.append(row)
-                line_count += 1
-    return data
-
-# open a text file  to read current cohort number
-
-
-def read_cohort_number(filepath):
-    with open(filepath) as cohort_file:
-        return int(cohort_file.read())
-
-
-# write a list of customers information to the csv database
-def write_customers_file(li, filepath):
-    with open(filepath, mode='w', newline='') as file:
-        writer = csv.writer(file, delimiter=',',
-                            quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['Customer', 'Balance',
-                        'IPv4 Address', '`Port1`', 'Port2', 'Cohort'])
-
-        for each in li:
-            writer.writerow(each)
-
-# write the current cohort number
-
-
-def write_cohort_number(number, filepath):
-    with open(filepath, 'w') as file:
-        file.write(str(number))
-
+    def _unindex(self, c):
+        if c.cohort == 0:
+            self.unassigned.remove(c.name)
+        else:
+            members = self.cohorts[c.cohort]
+            del members[c.name]
+            if not members:
+                del self.cohorts[c.cohort]
+            self._changed(c.cohort)
+
+    def _changed(self, cohort):
+        if self.cohort_cache is not None:
+            self.cohort_cache.invalidate(cohort)
+
+
+# LRU cache of the cohort members sent by "get", keyed by cohort number.
+# an entry holds the members as sent and their JSON encoding, so that a get
+# from a cohort whose members polled it before neither looks the members
+# up nor encodes them again. the registry drops the entry of a cohort as
+# soon as its members change (open, exit, new-cohort, delete-cohort, and
+# the journal replay), the least recently used entry goes when it is full
+class CohortCache:
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()    # cohort -> (members, encoded members)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # the entry of a cohort, None if it is not cached
+    def get(self, cohort):
+        entry = self.entries.get(cohort)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(cohort)
+        return entry
+
+    # cache the members of a cohort, returns the new entry
+    def put(self, cohort, members):
+        members = cohort_response(members)
+        entry = (members, json.dumps(members))
+        self.entries[cohort] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, cohort):
+        if self.entries.pop(cohort, None) is not None:
+            self.invalidations += 1
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
 
 class Bank:
 
     CUSTOMER_FILE_NAME = "customers.csv"
     COHORT_NUMBER_FILE_NAME = "cohort_number.txt"
+    JOURNAL_FILE_NAME = "customers.journal"
+    # binary snapshot of the database, see snapshot.py. csv files are only
+    # read when it does not exist yet, and for --import/--export
+    SNAPSHOT_FILE_NAME = "customers.snap"
+    # database of the sqlite storage
+    DATABASE_FILE_NAME = "customers.db"
+
+    # where the customers are stored, see storage.py:
+    #   journal: binary snapshot and journal of the mutations since
+    #   sqlite:  SQLite database, updated row by row
+    #   memory:  nowhere, the mutations are lost when the bank exits
+    STORAGES = ("journal", "sqlite", "memory")
+
+    # the journal is compacted into the snapshot once it holds this many
+    # records, or as many records as there are customers if that is more
+    JOURNAL_COMPACT_RECORDS = 10000
+
+    # when the journal is synced to disk:
+    #   fsync: after every mutating command, before its reply is sent
+    #   group: commands arriving within GROUP_COMMIT_WINDOW seconds, or up to
+    #          GROUP_COMMIT_MAX_BATCH of them, share one sync and their
+    #          replies are held back until it is done
+    #   async: every ASYNC_SYNC_INTERVAL seconds by a background thread,
+    #          replies are sent straight away and a crash may lose the
+    #          mutations of the last interval
+    SYNC_MODES = ("fsync", "group", "async")
+    GROUP_COMMIT_WINDOW = 0.002
+    GROUP_COMMIT_MAX_BATCH = 64
+    ASYNC_SYNC_INTERVAL = 0.05
+
+    # journal records handed over at once by import_customers
+    IMPORT_CHUNK = 10000
+
+    # commands of the clients, a datagram carries the first one it starts
+    # with. each is handled by the method of the same name, with "_" for "-".
+    # a datagram in the binary encoding of wire.py names its command
+    COMMANDS = ("open", "new-cohort", "delete-cohort", "exit", "get",
+                "partition-cohorts", "stats", "profile", "batch", "hello", "query")
+
+    # commands a batch can carry at most
+    BATCH_MAX_COMMANDS = 1000
+
+    # cohorts whose "get" response is cached, see CohortCache
+    GET_CACHE_SIZE = 4096
+
+    # replies kept for the retries of requests with an id, and for how
+    # many seconds, see RequestCache
+    REQUEST_CACHE_SIZE = 10000
+    REQUEST_CACHE_TTL = 60
+
+    # customers a "query" answers with by default, and at most
+    QUERY_PAGE = 100
+    QUERY_MAX_PAGE = 1000
+
+    # seconds between two dumps of the stats with --stats-file
+    STATS_INTERVAL = 10
+
+    # profiles of the serving loop, started by SIGUSR1 or a "profile"
+    # command, last PROFILE_DURATION seconds unless the command says
+    # otherwise, and never more than PROFILE_MAX_DURATION
+    PROFILE_DURATION = 10
+    PROFILE_MAX_DURATION = 300
+    PROFILE_PREFIX = "bank"
 
     # assigned port ranges
     GROUP_NUMBER = 39
@@ -60,83 +502,332 @@ class Bank:
     PORT_END = math.ceil(GROUP_NUMBER / 2) * 1000 + 999
 
     BUFFER_SIZE = 1024
+    # largest UDP payload over IPv4, for batches and their responses
+    MAX_DATAGRAM = 65507
     IP = "0.0.0.0"
     PORT = PORT_START
 
-    def __init__(self):
+    def __init__(self, sync_mode="fsync", reuse_port=False, storage="journal"):
+        if sync_mode not in Bank.SYNC_MODES:
+            raise ValueError(f"unknown sync mode {sync_mode}")
+        if storage not in Bank.STORAGES:
+            raise ValueError(f"unknown storage {storage}")
+
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # IP/UDP
+        # let several bank processes share the port, see shards.py
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind((Bank.IP, Bank.PORT))
 
         self.sock = sock
-        self.customers = read_csv_file(Bank.CUSTOMER_FILE_NAME)
-        self.cohort_number = read_cohort_number(Bank.COHORT_NUMBER_FILE_NAME)
+        self.metrics = Stats(sock)
+        self.profiler = Profiler(self.PROFILE_PREFIX)
+        self.profiling_signals = False
+        self.storage = self.make_storage(storage)
+        self.customers, self.cohort_number = load_database(self.storage)
+        self.committed_cohort_number = self.cohort_number
+
+        self.get_cache = CohortCache(self.GET_CACHE_SIZE)
+        self.customers.cohort_cache = self.get_cache
+        self.metrics.include("get_cache", self.get_cache.report)
+        self.requests = RequestCache(self.REQUEST_CACHE_SIZE, self.REQUEST_CACHE_TTL)
+        self.metrics.include("request_cache", self.requests.report)
+
+        self.storage.open(self.snapshot)
+
+        self.sync_mode = sync_mode
+        if sync_mode == "async":
+            self.storage.sync_periodically(Bank.ASYNC_SYNC_INTERVAL)
+
+        # replies waiting for the journal sync of their group commit
+        self.pending_replies = []
+        self.group_deadline = None
+
+    # the storage backend of the given kind, on this bank's files
+    def make_storage(self, kind):
+        if kind == "sqlite":
+            return SQLiteStorage(self.DATABASE_FILE_NAME, self.CUSTOMER_FILE_NAME,
+                                 self.COHORT_NUMBER_FILE_NAME)
+        if kind == "memory":
+            return MemoryStorage(self.CUSTOMER_FILE_NAME, self.COHORT_NUMBER_FILE_NAME)
+        return JournalStorage(self.SNAPSHOT_FILE_NAME, self.CUSTOMER_FILE_NAME,
+                              self.COHORT_NUMBER_FILE_NAME, self.JOURNAL_FILE_NAME,
+                              Bank.JOURNAL_COMPACT_RECORDS)
 
     def run(self):
+        self.handle_profiling_signals()
         while True:
-            data, addr = self.sock.recvfrom(1024)
-            data = data.decode()
-            response = None
+            # in group commit mode, wait for more commands only until the
+            # current group has to be synced
+            if self.pending_replies:
+                timeout = self.group_deadline - time.monotonic()
+                if timeout <= 0:
+                    self.release_replies()
+                    continue
+                self.sock.settimeout(timeout)
+            else:
+                self.sock.settimeout(None)
 
-            # read commands received from the socket
             try:
-                if data.startswith("open"):
-                    response = self.open(data, addr)
-                elif data.startswith("new-cohort"):
-                    response = self.new_cohort(data, addr)
-                elif data.startswith("delete-cohort"):
-                    response = self.delete_cohort(data, addr)
-                elif data.startswith("exit"):
-                    response = self.exit(data, addr)
-                elif data.startswith("get"):
-                    response = self.get(data, addr)
-                else:
-                    response = {"res": "FAILURE"}
-            except Exception as e:
-                response = {"res": "FAILURE"}
+                data, addr = self.sock.recvfrom(Bank.MAX_DATAGRAM)
+            except socket.timeout:
+                self.release_replies()
+                continue
+
+            start = time.perf_counter_ns()
+            command, data, binary, rid = self.decode(data)
+            parsed = time.perf_counter_ns()
+
+            # a retry gets the first reply again. in group commit mode it
+            # waits in the queue if that reply has not been released yet
+            if rid is not None:
+                datagrams = self.requests.get((addr[0], rid))
+                if datagrams is not None:
+                    self.reply(datagrams, addr)
+                    continue
+
+            response = self.handle(command, data, addr)
+            handled = time.perf_counter_ns()
+
+            # persist whatever the command changed before replying
+            self.commit()
+            persisted = time.perf_counter_ns()
+            datagrams = self.encode(command, response, binary, rid)
+            if rid is not None:
+                self.requests.put((addr[0], rid), datagrams)
+            self.reply(datagrams, addr)
+
+            self.metrics.record(command, (start, parsed, handled, persisted,
+                                         time.perf_counter_ns()))
+
+    # serve with an asyncio event loop instead of the blocking loop of run()
+    def run_async(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.handle_profiling_signals()
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: BankProtocol(self), sock=self.sock)
+        try:
+            await asyncio.Future()  # serve forever
+        finally:
+            transport.close()
+
+    # let SIGUSR1 start a profile of PROFILE_DURATION seconds.
+    # profiles are stopped by a SIGUSR2 that the profiler's timer sends to
+    # the serving thread, so that they end on it. python runs
+    # signal handlers on the main thread only, so profiling is only
+    # available when the bank serves on it
+    def handle_profiling_signals(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: self.start_profile(Bank.PROFILE_DURATION))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.profiler.stop())
+        self.profiling_signals = True
+
+    # profile the serving thread, returns the profile's file or None if a
+    # profile is already running
+    def start_profile(self, duration):
+        # sent to the thread rather than the process, so that it interrupts
+        # the wait for the next datagram
+        return self.profiler.start(duration, lambda: signal.pthread_kill(
+            threading.main_thread().ident, signal.SIGUSR2))
+
+    # the command a datagram carries, "unknown" if none
+    def parse(self, data):
+        for command in Bank.COMMANDS:
+            if data.startswith(command):
+                return command
+        return "unknown"
+
+    # the command a received datagram carries, the text command it is or
+    # stands for, whether it came in the binary encoding of wire.py, and
+    # its request id, None if it has none.
+    # a request with an id is "req <id> <command>", the id a number below
+    # 2 ** 64 chosen by the client. retries with the same id from the same
+    # host are only run once, see RequestCache.
+    # a malformed datagram is an unknown command
+    def decode(self, data):
+        binary = wire.is_binary(data)
+        if binary:
+            try:
+                command, data = wire.decode_request(data)
+            except ValueError:
+                return "unknown", "", True, None
+        else:
+            try:
+                data = data.decode()
+            except UnicodeDecodeError:
+                return "unknown", "", False, None
+
+        rid = None
+        if data.startswith("req "):
+            tokens = data.split(' ', 2)
+            if len(tokens) != 3 or not tokens[1].isdigit() or int(tokens[1]) >= 2 ** 64:
+                return "unknown", "", binary, None
+            rid, data = int(tokens[1]), tokens[2]
+
+        if not binary:
+            command = self.parse(data)
+        return command, data, binary, rid
+
+    # the datagrams of a response, in the encoding of its request, with the
+    # id of the request if it had one.
+    # a response that does not fit in a datagram and cannot be split (the
+    # whole of a large cohort) is replaced by a failure
+    def encode(self, command, response, binary, rid=None):
+        if binary:
+            datagrams = [wire.encode_response(command, response, rid)]
+        else:
+            datagrams = encode_response(
+                response if rid is None else with_request_id(response, rid))
+
+        if any(len(datagram) > Bank.MAX_DATAGRAM for datagram in datagrams):
+            self.metrics.record_error(command, "response too large")
+            return self.encode(command, {"res": "FAILURE", "reason": (
+                "response too large, use get <customer> <first> <page size>")}, binary, rid)
+        return datagrams
+
+    # run a single command and return its response
+    # failures are counted by reason: the exception raised by the handler,
+    # the reason given by the handler, or "refused"
+    def handle(self, command, data, addr):
+        if command == "unknown":
+            self.metrics.record_error(command, "unknown command")
+            return {"res": "FAILURE"}
 
-            # if the response has a success status code, update relevant text files.
-            if response['res'] == 'SUCCESS':
-                # write to files
-                write_customers_file(self.customers, Bank.CUSTOMER_FILE_NAME)
-                write_cohort_number(self.cohort_number,
-                                    Bank.COHORT_NUMBER_FILE_NAME)
+        try:
+            response = getattr(self, command.replace("-", "_"))(data, addr)
+        except Exception as e:
+            self.metrics.record_error(command, type(e).__name__)
+            return {"res": "FAILURE"}
 
-            self.sock.sendto(json.dumps(response).encode(), addr)
+        if response["res"] != "SUCCESS":
+            self.metrics.record_error(command, response.get("reason", "refused"))
+        return response
+
+    # send the datagrams of a response, unless they have to wait for their
+    # group commit. replies are kept in order, so a reply queued behind a
+    # pending mutation waits as well
+    def reply(self, datagrams, addr):
+        if self.sync_mode != "group" or not (self.pending_replies or self.storage.dirty):
+            self.send(datagrams, addr)
+            return
+
+        if not self.pending_replies:
+            self.group_deadline = time.monotonic() + Bank.GROUP_COMMIT_WINDOW
+        self.pending_replies.append((datagrams, addr))
+
+        if len(self.pending_replies) >= Bank.GROUP_COMMIT_MAX_BATCH:
+            self.release_replies()
+
+    # sync the current group commit and send its replies
+    def release_replies(self):
+        start = time.perf_counter_ns()
+        self.storage.sync()
+        self.metrics.record_operation("group-sync", time.perf_counter_ns() - start)
+        for datagrams, addr in self.pending_replies:
+            self.send(datagrams, addr)
+        self.pending_replies = []
+
+    # send the datagrams of a reply. a datagram the system refuses to send
+    # is dropped and counted, it does not stop the bank
+    def send(self, datagrams, addr):
+        for datagram in datagrams:
+            try:
+                self.sock.sendto(datagram, addr)
+            except OSError as e:
+                self.metrics.record_error("reply", type(e).__name__)
+
+    # append the changes made since the last commit to the journal.
+    # in fsync mode they are synced too, unless sync is False.
+    # returns whether there was anything to write
+    def commit(self, sync=True):
+        records = self.customers.take_changes()
+        if self.cohort_number != self.committed_cohort_number:
+            records.append(["next", self.cohort_number])
+            self.committed_cohort_number = self.cohort_number
+
+        if not records:
+            return False
+
+        self.storage.write(records)
+        if sync and self.sync_mode == "fsync":
+            self.storage.sync()
+
+        self.storage.maintain(len(self.customers))
+        return True
+
+    # register every customer of a csv file laid out like customers.csv
+    # the file is streamed, each row is checked like an "open" command and
+    # rows that "open" would refuse (invalid fields, duplicate names) are
+    # skipped. imported customers start without a cohort, whatever the
+    # file says. the journal is synced once, at the end.
+    # returns the number of imported and of skipped rows
+    def import_customers(self, filepath):
+        imported = skipped = 0
+
+        with open(filepath, newline='') as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            next(csv_reader, None)  # header
+
+            for row in csv_reader:
+                if not valid_customer(row) or row[0] in self.customers:
+                    skipped += 1
+                    continue
+
+                self.customers.add(CustomerRecord.from_row(row[:5]))
+                imported += 1
+
+                # hand the records to the journal in chunks, without syncing
+                if imported % Bank.IMPORT_CHUNK == 0:
+                    self.commit(sync=False)
+
+        self.commit(sync=False)
+        self.storage.sync()
+        return imported, skipped
+
+    # write the customers and their cohorts to a csv file laid out like
+    # customers.csv, straight from the registry
+    def export_customers(self, filepath):
+        write_customers_file(self.customers, filepath)
+
+    # copy the current state and return a function writing it to the snapshot
+    # the copy is made on the serving thread, the write in the background
+    def snapshot(self):
+        start = time.perf_counter_ns()
+        rows = [c.fields() for c in self.customers]
+        cohort_number = self.cohort_number
+        self.metrics.record_operation("snapshot-copy", time.perf_counter_ns() - start)
+
+        def write_snapshot():
+            start = time.perf_counter_ns()
+            write_snapshot_file(rows, cohort_number, self.SNAPSHOT_FILE_NAME)
+            self.metrics.record_operation("snapshot-write", time.perf_counter_ns() - start)
+
+        return write_snapshot
 
     def open(self, data, addr):
         # tokenize the command string, excluding the first parameter
         tokens = data.split(' ')[1:]
 
-        name = tokens[0]
-        balance = tokens[1]
-        address = tokens[2]
-        server_port = tokens[3]
-        client_port = tokens[4]
-
-        # check if address field in the command is in correct ipv4 format
-        def validIP(address: str) -> bool:
-            return True if type(ip_address(address)) is IPv4Address else False
-
-        # if there are more than one customer in the same host, check if they are using different port number
-
-        if (len(name) > 15 or (server_port == client_port) or not validIP(address)):
+        if len(tokens) != 5 or not valid_customer(tokens):
             return {"res": "FAILURE"}
 
-        # if the customer already exists in the database
-        for c in self.customers:
-            if name == c[0]:
-                return {"res": "FAILURE"}
-
-        # Add customer information to database
-        if (tokens not in self.customers):
+        name = tokens[0]
 
-            # add a cohort number field to the end of the customer information
-            tokens.append('0')
-            self.customers.append(tokens)
-            return {"res": "SUCCESS"}
-        else:
+        # if the customer already exists in the database
+        if name in self.customers:
             return {"res": "FAILURE"}
 
+        # Add customer information to database, without a cohort: from_row
+        # would read a sixth field as one
+        self.customers.add(CustomerRecord.from_row(tokens[:5]))
+        return {"res": "SUCCESS"}
+
     def new_cohort(self, data, addr):
         tokens = data.split(' ')
 
@@ -151,39 +842,77 @@ class Bank:
             return {"res": "FAILURE"}
 
         res = []
-        # temporary array to store any customers that are not already in a cohort
-        customers_without_cohort = []
+        c = self.customers.get(customer)
 
-        for c in self.customers:
-            name = c[0]
-            cohort = c[5]
-
-            if name == customer:    # if the customer is in the database but already has a cohort
-                if int(cohort) != 0:
-                    return {"res": "FAILURE"}
-                else:
-                    res.append(c)
-            else:
-                if int(cohort) == 0:    # if the customer is in the database and doesn't have a cohort
-                    customers_without_cohort.append(c)
+        if c is not None:
+            if c.cohort != 0:   # if the customer is in the database but already has a cohort
+                return {"res": "FAILURE"}
+            res.append(c)
 
-        if len(customers_without_cohort) < n - 1:
+        # customers that are not already in a cohort, other than the requester
+        available = len(self.customers.unassigned) - len(res)
+        if available < n - 1:
             return {"res": "FAILURE"}
 
-        # randomly choose a list of customers without cohorts
-        picked_customers = random.choices(customers_without_cohort, k=n-1)
+        # randomly choose distinct customers without cohorts
+        picked_customers = self.customers.unassigned.sample(n - 1, exclude=customer)
 
         for c in picked_customers:  # append the picked customers to the new cohort
             res.append(c)
 
-        for c in res:
-            # update the cohort number, incremented from the latest exisiting cohort number
-            c[5] = self.cohort_number
+        # update the cohort number, incremented from the latest exisiting cohort number
+        self.customers.assign_all(res, self.cohort_number)
         self.cohort_number += 1
 
         return {
             "res": "SUCCESS",
-            "data": res
+            "data": [c.row() for c in res]
+        }
+
+    # split customers without a cohort into cohorts of n members at once
+    # the cohorts get consecutive cohort numbers and are persisted together
+    # params:
+    #   data: string type, command given by client
+    #         string format is "partition-cohorts <n> [<count>]", where
+    #         count is the number of customers to place, all by default.
+    #         customers left over when count is not a multiple of n stay
+    #         without a cohort
+    #   addr: tuple of connected client's addr and port
+    # return:
+    #   on success: {"res": "SUCCESS", "data": {"first": <first cohort number>,
+    #                "last": <last cohort number>, "cohorts": <number of cohorts>,
+    #                "size": n, "customers": <number of customers placed>}}
+    #   on failure: {"res": "FAILURE"}
+    def partition_cohorts(self, data, addr):
+        tokens = data.split()
+        pool = self.customers.unassigned
+
+        if len(tokens) not in (2, 3):
+            return {"res": "FAILURE"}
+
+        n = int(tokens[1])
+        count = int(tokens[2]) if len(tokens) == 3 else len(pool)
+
+        if n < 2 or count < n or count > len(pool):
+            return {"res": "FAILURE"}
+
+        cohorts = count // n
+        picked = pool.sample(cohorts * n)
+        first = self.cohort_number
+
+        for i in range(cohorts):
+            self.customers.assign_all(picked[i * n:(i + 1) * n], first + i)
+        self.cohort_number += cohorts
+
+        return {
+            "res": "SUCCESS",
+            "data": {
+                "first": first,
+                "last": first + cohorts - 1,
+                "cohorts": cohorts,
+                "size": n,
+                "customers": cohorts * n
+            }
         }
 
     # delete a cohort group that a member belongs to
@@ -205,30 +934,14 @@ class Bank:
             return failure_response
 
         command, customer = tokens
-        has_group = False
-        customer_cohort = 0
-
-        # find if the member exists and he/she is
-        # in cohort
-        for c in self.customers:
-            name = c[0]
-            cohort = c[5]
-
-            if name == customer and cohort != 0:
-                has_group = True
-                customer_cohort = cohort
-                break
+        c = self.customers.get(customer)
 
         # member not exists or member not belongs to cohort
-        if not has_group:
+        if c is None or c.cohort == 0:
             return failure_response
 
-        # removes other members from the same cohort
-        for c in self.customers:
-            cohort = c[5]
-
-            if cohort == customer_cohort:
-                c[5] = 0
+        # removes all members, including this one, from the same cohort
+        self.customers.dissolve(c.cohort)
 
         return success_response
 
@@ -248,7 +961,6 @@ class Bank:
 
         tokens = data.split()
         command, customer = tokens
-        user_exists = False
 
         self.delete_cohort(f"delete-cohort {customer}", addr)
 
@@ -256,74 +968,498 @@ class Bank:
             return failure_response
 
         # check if user exists
-        for i, c in enumerate(self.customers):
-            name = c[0]
-
-            if name == customer:
-                user_exists = True
-                break
-
-        if user_exists:
-            self.customers.pop(i)
+        if customer in self.customers:
+            self.customers.remove(customer)
             return success_response
         else:
             return failure_response
 
+    # a customer's balance and the members of its cohort, whole or a page
+    # at a time for cohorts too large for the client's receive buffer
+    # params:
+    #   data: string type, command given by client
+    #         string format is "get <customer>" for the whole cohort, or
+    #         "get <customer> <first> <page size>" for the members from the
+    #         first-th on that fit in a response of page size bytes
+    #   addr: tuple of connected client's addr and port
+    # return:
+    #   on success: {"res": "SUCCESS", "data": {"balance", "cohort", "name"}},
+    #               a page also has "members": <cohort size> and, unless it
+    #               is the last one, "next": <first member of the next page>
+    #   on failure: {"res": "FAILURE"}, or with a reason for an invalid page
     def get(self, data, addr):
-
-        success_response = {
-            "res": "SUCCESS",
-            "data": {
-                "balance": -1,
-                "cohort": []
-            }
-        }
         failure_response = {"res": "FAILURE"}
 
-        tokens = data.split()
-        command, customer = tokens
-        user_exists = False
-        user_cohort = 0
-
-        if len(tokens) != 2:
+        request = parse_get(data)
+        if request is None:
             return failure_response
+        customer, page = request
 
         # check if user exists
-        for i, c in enumerate(self.customers):
-            name = c[0]
-            balance = c[1]
-            cohort = c[5]
-
-            if name == customer:
-                success_response['data']['name'] = name
-                success_response['data']['balance'] = balance
-                user_exists = True
-                user_cohort = cohort
+        c = self.customers.get(customer)
+        if c is None:
+            return failure_response
+
+        # a customer without a cohort only sees itself
+        if c.cohort == 0:
+            return get_response(c, [c], page)
+        if page is not None:
+            return get_response(c, self.customers.members(c.cohort), page)
+
+        entry = self.get_cache.get(c.cohort)
+        if entry is None:
+            entry = self.get_cache.put(c.cohort, self.customers.members(c.cohort))
+        return cached_get_response(c, entry)
+
+    # counters and latencies of this bank since it started, see stats.py
+    # params:
+    #   data: string type, command given by client
+    #         string format is "stats"
+    #   addr: tuple of connected client's addr and port
+    # return:
+    #   on success: {"res": "SUCCESS", "data": {"uptime": <seconds>,
+    #                "commands": {<command>: {"count", "per_second", "phases":
+    #                {<phase>: <latency histogram>}}}, "operations":
+    #                {<operation>: <latency histogram>}, "errors":
+    #                {"<command>: <reason>": <count>}, "receive_queue":
+    #                {"bytes", "drops", "buffer"}}}
+    def stats(self, data, addr):
+        return {"res": "SUCCESS", "data": self.metrics.report()}
+
+    # run several commands sent in one datagram, one after the other.
+    # the changes of the whole batch are persisted at once, after it ran
+    # params:
+    #   data: string type, command given by client
+    #         string format is "batch\n<command>\n<command>...", with at
+    #         most BATCH_MAX_COMMANDS commands, none of them a batch
+    #   addr: tuple of connected client's addr and port
+    # return:
+    #   on success: {"res": "SUCCESS", "data": [<response of each command>]},
+    #               split over several datagrams if it does not fit in one,
+    #               see encode_response()
+    #   on failure: {"res": "FAILURE", "reason": <reason>}
+    def batch(self, data, addr):
+        commands = data.split("\n")[1:]
+        if not commands or len(commands) > Bank.BATCH_MAX_COMMANDS:
+            return {"res": "FAILURE", "reason": "invalid batch size"}
+
+        responses = []
+        for data in commands:
+            command = self.parse(data)
+            if command in ("batch", "profile"):
+                responses.append({"res": "FAILURE", "reason": "not allowed in a batch"})
+            else:
+                responses.append(self.handle(command, data, addr))
+
+        return {"res": "SUCCESS", "data": responses}
+
+    # look customers up through the indexes of the registry, a page at a
+    # time. read-only, and answered in time proportional to the page
+    # params:
+    #   data: string type, command given by client
+    #         string format is "query <index> [<value>] [<first> <count>]":
+    #           query cohort <cohort number>
+    #           query host <ipv4>
+    #           query unassigned
+    #           query balance-above <amount>
+    #         for the matches from the first-th on, at most count of them
+    #         (QUERY_PAGE by default, QUERY_MAX_PAGE at most)
+    #   addr: tuple of connected client's addr and port
+    # return:
+    #   on success: {"res": "SUCCESS", "data": [<customer row>...],
+    #                "total": <matches>}, with "next": <first match of the
+    #                next page> unless it is the last page
+    #   on failure: {"res": "FAILURE", "reason": <reason>}
+    def query(self, data, addr):
+        request = parse_query(data)
+        if request is None:
+            return {"res": "FAILURE", "reason": "invalid query"}
+
+        index, value, first, count = request
+        total, records = self.customers.query(index, value, first, count)
+        return query_response([c.row() for c in records], total, first)
+
+    # the versions of the binary encoding of wire.py this bank takes.
+    # clients ask before sending it, see Customer.send()
+    # params:
+    #   data: string type, command given by client
+    #         string format is "hello"
+    #   addr: tuple of connected client's addr and port
+    # return:
+    #   on success: {"res": "SUCCESS", "data": {"wire": [<version>...]}}
+    def hello(self, data, addr):
+        return {"res": "SUCCESS", "data": {"wire": wire.VERSIONS}}
+
+    # profile the bank's dispatch loop, handlers and persistence for a
+    # while, see profiling.py. only taken from the bank's own host
+    # params:
+    #   data: string type, command given by client
+    #         string format is "profile [<seconds>]" to start a profile,
+    #         "profile stop" to end it early
+    #   addr: tuple of connected client's addr and port
+    # return:
+    #   on success: {"res": "SUCCESS", "data": {"file": <profile file>}},
+    #               the file is written once the profile ends
+    #   on failure: {"res": "FAILURE", "reason": <reason>}
+    def profile(self, data, addr):
+        tokens = data.split()
+
+        if not ip_address(addr[0]).is_loopback:
+            return {"res": "FAILURE", "reason": "only taken from the bank's host"}
+        if not self.profiling_signals:
+            return {"res": "FAILURE", "reason": "the bank does not serve on the main thread"}
+
+        if len(tokens) == 2 and tokens[1] == "stop":
+            filepath = self.profiler.stop()
+            if filepath is None:
+                return {"res": "FAILURE", "reason": "no profile is running"}
+            return {"res": "SUCCESS", "data": {"file": filepath}}
+
+        duration = float(tokens[1]) if len(tokens) == 2 else Bank.PROFILE_DURATION
+        if not 0 < duration <= Bank.PROFILE_MAX_DURATION:
+            return {"res": "FAILURE", "reason": "invalid duration"}
+
+        filepath = self.start_profile(duration)
+        if filepath is None:
+            return {"res": "FAILURE", "reason": "a profile is already running"}
+        return {"res": "SUCCESS", "data": {"file": filepath}}
+
+
+# replies to the requests with an id of the last ttl seconds, at most size
+# of them, keyed by (client host, request id). a retried request is answered
+# with the datagrams of its first reply instead of being run again. the
+# entries are kept in the order they were added, which is also the order
+# they expire in, and the oldest ones go first when it is full
+class RequestCache:
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()    # key -> (expiry, datagrams)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # the datagrams replied to a request, None if it is not known
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, key, datagrams):
+        now = time.monotonic()
+        self.entries.pop(key, None)
+        self.entries[key] = (now + self.ttl, datagrams)
+        while self.entries:
+            expiry = next(iter(self.entries.values()))[0]
+            if expiry > now and len(self.entries) <= self.size:
                 break
+            self.entries.popitem(last=False)
+            if expiry > now:
+                self.evictions += 1
 
-        if not user_exists:
-            return failure_response
+    def report(self):
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
 
-        for i, c in enumerate(self.customers):
-            # Customer,Balance,IPv4 Address,Port1,Port2,Cohort
-            name = c[0]
-            balance = c[1]
-            ipv4 = c[2]
-            port1 = c[3]
-            port2 = c[4]
-            cohort = c[5]
-
-            if cohort == user_cohort:
-                success_response['data']['cohort'].append({
-                    "name": name,
-                    "ipv4": ipv4,
-                    "port2": port2
-                })
 
+# the customer and the page a "get" asks for: (customer, None) for the
+# whole cohort, (customer, (first, page size)) for a page, None if malformed
+def parse_get(data):
+    tokens = data.split()
+    if len(tokens) == 2:
+        return tokens[1], None
+    if len(tokens) == 4 and tokens[2].isdigit() and tokens[3].isdigit():
+        return tokens[1], (int(tokens[2]), int(tokens[3]))
+    return None
+
+
+# the query a "query" asks for: (index, value, first, count), None if
+# malformed. see Bank.query()
+def parse_query(data):
+    tokens = data.split()
+    if len(tokens) < 2 or tokens[1] not in ("cohort", "host", "unassigned", "balance-above"):
+        return None
+
+    index = tokens[1]
+    value = None
+    if index != "unassigned":
+        if len(tokens) < 3:
+            return None
+        value = tokens[2]
+        if index != "host":
+            if not value.isdigit():
+                return None
+            value = int(value)
+
+    page = tokens[2:] if index == "unassigned" else tokens[3:]
+    if not page:
+        return index, value, 0, Bank.QUERY_PAGE
+    if len(page) != 2 or not page[0].isdigit() or not page[1].isdigit():
+        return None
+    first, count = int(page[0]), int(page[1])
+    if not 0 < count <= Bank.QUERY_MAX_PAGE:
+        return None
+    return index, value, first, count
+
+
+# the response of "query" for a page of rows starting at the first-th match
+def query_response(rows, total, first):
+    response = {"res": "SUCCESS", "data": rows, "total": total}
+    if first + len(rows) < total:
+        response["next"] = first + len(rows)
+    return response
+
+
+# build the response of "get" for a customer record and the records of its cohort
+# balances and ports are sent as strings, as they appear in customers.csv
+# with a page, only the members from the first one on that fit in a response
+# of the page size are sent, see Bank.get()
+def get_response(c, members, page=None):
+    success_response = {
+        "res": "SUCCESS",
+        "data": {
+            "balance": str(c.balance),
+            "cohort": [],
+            "name": c.name
+        }
+    }
+
+    if page is None:
+        success_response['data']['cohort'] = cohort_response(members)
         return success_response
 
+    first, size = page
+    if first >= len(members) or size > Bank.MAX_DATAGRAM:
+        return {"res": "FAILURE", "reason": "invalid page"}
+
+    # the encoded size of the page so far: the response without members, with
+    # room for a "next" key and for the largest request id that
+    # with_request_id() may add, then each member with its ", " separator
+    success_response["members"] = len(members)
+    length = (len(json.dumps(success_response).encode()) + len(f', "next": {len(members)}')
+              + len(f', "id": {2 ** 64 - 1}'))
+    cohort = success_response['data']['cohort']
+    for member in cohort_response(itertools.islice(members, first, None)):
+        length += len(json.dumps(member).encode()) + (2 if cohort else 0)
+        if length > size:
+            break
+        cohort.append(member)
+
+    if not cohort:
+        return {"res": "FAILURE", "reason": "page size too small"}
+    if first + len(cohort) < len(members):
+        success_response["next"] = first + len(cohort)
+    return success_response
+
+
+# the cohort members of a "get" response
+def cohort_response(members):
+    return [{"name": m.name, "ipv4": m.ipv4, "port2": str(m.port2)} for m in members]
+
+
+# a response that comes with its JSON encoding, see encode_response()
+class EncodedResponse(dict):
+
+    __slots__ = ("encoded",)
+
+
+# the response of "get" for a customer from the cache entry of its cohort.
+# the members are shared with the cache and must not be changed; the
+# encoding is the one json.dumps() gives, put together around the cached
+# encoding of the members
+def cached_get_response(c, entry):
+    members, encoded = entry
+    response = EncodedResponse(
+        res="SUCCESS", data={"balance": str(c.balance), "cohort": members, "name": c.name})
+    response.encoded = ('{"res": "SUCCESS", "data": {"balance": "%d", "cohort": %s, "name": %s}}'
+                        % (c.balance, encoded, json.dumps(c.name))).encode()
+    return response
+
+
+# a response with the id of its request as "id"
+def with_request_id(response, rid):
+    if type(response) is EncodedResponse:
+        tagged = EncodedResponse(response, id=rid)
+        tagged.encoded = response.encoded[:-1] + b', "id": %d}' % rid
+        return tagged
+    return dict(response, id=rid)
+
+
+# encode a response into the datagrams carrying it
+# a response too large for one datagram whose data is a list (the response
+# of a batch) is split into parts, each with a slice of the data and
+# "part": i, "parts": n, to be joined back by the client in order.
+# other responses are kept whole, see Bank.encode() for those too large
+def encode_response(response):
+    if type(response) is EncodedResponse:
+        return [response.encoded]
+    datagram = json.dumps(response).encode()
+    if len(datagram) <= Bank.MAX_DATAGRAM or not isinstance(response.get("data"), list):
+        return [datagram]
+
+    # cut the data into as many even slices as the size calls for, and into
+    # more if some slice still does not fit
+    data = response["data"]
+    parts = -(-len(datagram) // Bank.MAX_DATAGRAM)
+    while True:
+        size = -(-len(data) // parts)
+        slices = [data[i:i + size] for i in range(0, len(data), size)]
+        datagrams = [json.dumps(dict(response, data=chunk, part=i, parts=len(slices))).encode()
+                     for i, chunk in enumerate(slices)]
+        if size == 1 or all(len(each) <= Bank.MAX_DATAGRAM for each in datagrams):
+            return datagrams
+        parts += 1
+
+
+# asyncio front end of the bank
+# datagrams are received, parsed and handled on the event loop, the
+# handlers only touch memory. journal syncs run in a single worker thread,
+# in order, and a reply is sent once the sync covering its command is done,
+# so a slow disk no longer stalls the other clients. since a sync covers
+# everything written before it, commands arriving during a sync share the
+# next one, whatever the sync mode.
+class BankProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, bank):
+        self.bank = bank
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.transport = None
+        # syncs submitted to the executor and not done yet
+        self.pending_syncs = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.executor.shutdown(wait=True)
+
+    def datagram_received(self, data, addr):
+        start = time.perf_counter_ns()
+        command, data, binary, rid = self.bank.decode(data)
+        parsed = time.perf_counter_ns()
+
+        # a retry gets the first reply again, once the sync of the first one
+        # is done: the executor runs in order, so after the pending syncs
+        if rid is not None:
+            datagrams = self.bank.requests.get((addr[0], rid))
+            if datagrams is not None:
+                if self.bank.sync_mode == "async":
+                    self.resend(datagrams, addr)
+                else:
+                    # looked up again once the syncs are done, a failed sync
+                    # replaces the reply
+                    future = asyncio.get_running_loop().run_in_executor(
+                        self.executor, lambda: None)
+                    future.add_done_callback(lambda f: self.resend(
+                        self.bank.requests.get((addr[0], rid)) or datagrams, addr))
+                return
+
+        response = self.bank.handle(command, data, addr)
+        handled = time.perf_counter_ns()
+        datagrams = self.bank.encode(command, response, binary, rid)
+        if rid is not None:
+            self.bank.requests.put((addr[0], rid), datagrams)
+
+        # async mode replies straight away, and so do read-only commands
+        # unless a sync is pending: they may have read what it persists, so
+        # they wait for it behind a no-op, like the retries
+        mutated = self.bank.commit(sync=False)
+        if self.bank.sync_mode == "async" or not (mutated or self.pending_syncs):
+            self.reply(datagrams, addr, command, (start, parsed, handled))
+            return
+
+        if not mutated:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, lambda: None)
+            future.add_done_callback(lambda f: self.reply(
+                datagrams, addr, command, (start, parsed, handled)))
+            return
+
+        # the persist phase lasts until the sync is done
+        self.pending_syncs += 1
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.bank.storage.sync)
+        future.add_done_callback(lambda f: self.synced(
+            f, datagrams, addr, command, binary, rid, (start, parsed, handled)))
+
+    # send the reply of a command once its sync is done. if the sync
+    # failed, the changes of the command are not known to be durable: the
+    # failure is counted and logged, and the client gets a failure instead,
+    # retries included
+    def synced(self, future, datagrams, addr, command, binary, rid, timestamps):
+        self.pending_syncs -= 1
+        exc = future.exception()
+        if exc is not None:
+            print(f"sync failed: {exc!r}", file=sys.stderr)
+            self.bank.metrics.record_error(command, type(exc).__name__)
+            datagrams = self.bank.encode(command, {"res": "FAILURE"}, binary, rid)
+            if rid is not None:
+                self.bank.requests.put((addr[0], rid), datagrams)
+        self.reply(datagrams, addr, command, timestamps)
+
+    def reply(self, datagrams, addr, command, timestamps):
+        persisted = time.perf_counter_ns()
+        for datagram in datagrams:
+            self.transport.sendto(datagram, addr)
+        self.bank.metrics.record(command, timestamps + (persisted, time.perf_counter_ns()))
+
+    def resend(self, datagrams, addr):
+        for datagram in datagrams:
+            self.transport.sendto(datagram, addr)
 
 
 if __name__ == "__main__":
-    bank = Bank()
-    bank.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sync", choices=Bank.SYNC_MODES, default="fsync",
+                        help="when mutations are synced to disk")
+    parser.add_argument("--storage", choices=Bank.STORAGES, default="journal",
+                        help="where the customers are stored, see storage.py")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve with an asyncio event loop")
+    parser.add_argument("--import", dest="import_file", metavar="CSV",
+                        help="register the customers of a csv file and exit")
+    parser.add_argument("--export", dest="export_file", metavar="CSV",
+                        help="write the customers to a csv file and exit")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes sharing the port, see shards.py")
+    parser.add_argument("--stats-file", metavar="FILE",
+                        help="dump the stats to a json file periodically, "
+                             "one file per worker with --workers")
+    parser.add_argument("--stats-interval", type=float, default=Bank.STATS_INTERVAL,
+                        help="seconds between two dumps of the stats")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if (args.asyncio or args.sync == "group" or args.import_file or args.export_file
+                or args.storage != "journal"):
+            parser.error("--workers cannot be combined with --asyncio, "
+                         "--sync group, --storage, --import or --export")
+        from shards import run_workers
+        run_workers(args.workers, sync_mode=args.sync,
+                    stats_file=args.stats_file, stats_interval=args.stats_interval)
+        sys.exit()
+
+    bank = Bank(sync_mode=args.sync, storage=args.storage)
+    if args.stats_file:
+        bank.metrics.dump_periodically(args.stats_file, args.stats_interval)
+    if args.import_file or args.export_file:
+        if args.import_file:
+            imported, skipped = bank.import_customers(args.import_file)
+            print(f"imported {imported} customers, skipped {skipped} rows")
+        if args.export_file:
+            bank.export_customers(args.export_file)
+        bank.storage.close()
+    elif args.asyncio:
+        bank.run_async()
+    else:
+        bank.run()
@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import json
+import socket
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import Bank, write_customers_file, write_cohort_number  # noqa: E402
+from customer import Customer  # noqa: E402
+
+# throughput of "get" and "open" sent one per datagram against sent in
+# batches, with one datagram in flight. the bank runs in its own process
+# on loopback, in the given sync mode.
+# usage: python benchmarks/batching.py [commands] [batch size] [sync mode]
+
+COMMANDS = 20000
+BATCH = 100
+CUSTOMERS = 10000
+
+
+def serve(directory, sync_mode, port):
+    os.chdir(directory)
+    Bank.IP = "127.0.0.1"
+    Bank.PORT = port
+    Bank(sync_mode=sync_mode).run()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_commands(kind, count, offset):
+    if kind == "get":
+        return [f"get c{i % CUSTOMERS}" for i in range(count)]
+    return [f"open n{offset + i} 100 127.0.0.1 {1024 + i % 60000} {1025 + i % 60000}"
+            for i in range(count)]
+
+
+def one_by_one(addr, commands):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5)
+    start = time.perf_counter()
+    for command in commands:
+        sock.sendto(command.encode(), addr)
+        assert json.loads(sock.recvfrom(Bank.MAX_DATAGRAM)[0])["res"] == "SUCCESS"
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return len(commands) / elapsed
+
+
+def batched(addr, commands, size):
+    customer = Customer()
+    customer.sock.settimeout(5)
+    start = time.perf_counter()
+    for i in range(0, len(commands), size):
+        msg = customer.send_batch(addr, commands[i:i + size])
+        assert all(each["res"] == "SUCCESS" for each in msg["data"])
+    elapsed = time.perf_counter() - start
+    customer.sock.close()
+    return len(commands) / elapsed
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COMMANDS
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else BATCH
+    sync_mode = sys.argv[3] if len(sys.argv) > 3 else "fsync"
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_customers_file([[f"c{i}", "100", "127.0.0.1", str(1024 + i % 60000),
+                               str(1025 + i % 60000), 0] for i in range(CUSTOMERS)],
+                             os.path.join(directory, Bank.CUSTOMER_FILE_NAME))
+        write_cohort_number(1, os.path.join(directory, Bank.COHORT_NUMBER_FILE_NAME))
+
+        port = free_port()
+        server = multiprocessing.Process(
+            target=serve, args=(directory, sync_mode, port), daemon=True)
+        server.start()
+        time.sleep(1)
+        addr = ("127.0.0.1", port)
+        try:
+            print(f"{count} commands, batches of {size}, {sync_mode} sync")
+            for kind in ("get", "open"):
+                single = one_by_one(addr, make_commands(kind, count, 0))
+                batch = batched(addr, make_commands(kind, count, count), size)
+                print(f"{kind:>5}: {single:>10.0f} ops/s one by one, "
+                      f"{batch:>10.0f} ops/s batched ({batch / single:.1f}x)")
+        finally:
+            server.terminate()
+            server.join()
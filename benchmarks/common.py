@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import Bank, write_customers_file, write_cohort_number  # noqa: E402
+
+# helpers shared by the benchmarks that build a bank in a directory of
+# their own and call its handlers directly
+
+
+# rows of customers.csv for the given number of customers, all without a
+# cohort. the ports cycle through 1024..61024, so they stay 16 bit ports
+# whatever the size
+def make_rows(size):
+    return [[f"c{i}", "100", "127.0.0.1", str(1024 + i % 60000), str(1025 + i % 60000), 0]
+            for i in range(size)]
+
+
+# a bank over a database of the given number of customers, in directory
+def make_bank(size, directory):
+    write_customers_file(make_rows(size), os.path.join(directory, Bank.CUSTOMER_FILE_NAME))
+    write_cohort_number(1, os.path.join(directory, Bank.COHORT_NUMBER_FILE_NAME))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        Bank.PORT = 0   # any free port, the socket is not used
+        return Bank()
+    finally:
+        os.chdir(cwd)
+
+
+def close_bank(bank):
+    bank.storage.close()
+    bank.sock.close()
@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import selectors
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import Bank, write_customers_file, write_cohort_number  # noqa: E402
+
+# end-to-end load test of the bank on loopback.
+# "bank.py" is started on a fresh database of --customers customers, then
+# --processes processes drive --clients simulated clients in total. each
+# client has one request in flight, and picks its commands at random from
+# the --mix weights:
+#   open           registers a new customer of its own
+#   get            looks up a random preloaded customer
+#   new-cohort     puts one of its customers into a new cohort of --cohort
+#   delete-cohort  dissolves the cohort of one of its customers
+#   exit           removes one of its customers
+# a request without a reply after --timeout seconds is counted as lost, and
+# the client goes on from a fresh socket so that a late reply is not taken
+# for the reply of its next request.
+# the report (throughput, latency percentiles, failures and losses per
+# command, and the bank's own "stats") is printed as a table and written
+# as json with --output, to be compared across changes.
+# usage: python benchmarks/load.py [--duration 10] [--clients 32] [--output load.json]
+
+BANK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bank.py")
+COMMANDS = ("open", "get", "new-cohort", "delete-cohort", "exit")
+MIX = "open=20,get=50,new-cohort=10,delete-cohort=10,exit=10"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        command, weight = part.split("=")
+        if command not in COMMANDS:
+            raise ValueError(f"unknown command {command}")
+        mix[command] = float(weight)
+    return mix
+
+
+# one simulated client, with its own socket and customers
+class Client:
+
+    def __init__(self, name, args, rng):
+        self.name = name
+        self.args = args
+        self.rng = rng
+        self.sock = None
+        self.opened = []        # customers it registered
+        self.in_cohort = []     # those of them it put into a cohort
+        self.count = 0
+        self.command = None
+        self.request = None
+        self.sent_at = None
+
+    def new_socket(self, selector):
+        if self.sock is not None:
+            selector.unregister(self.sock)
+            self.sock.close()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        selector.register(self.sock, selectors.EVENT_READ, self)
+
+    # the next request, falling back to "get" or "open" when the client
+    # has no customer to run the drawn command on
+    def next_request(self, mix):
+        command = self.rng.choices(list(mix), weights=list(mix.values()))[0]
+        free = [name for name in self.opened if name not in self.in_cohort]
+
+        if command == "new-cohort" and free:
+            return command, f"new-cohort {self.rng.choice(free)} {self.args.cohort}"
+        if command == "delete-cohort" and self.in_cohort:
+            return command, f"delete-cohort {self.rng.choice(self.in_cohort)}"
+        if command == "exit" and self.opened:
+            return command, f"exit {self.rng.choice(self.opened)}"
+        if command in ("open", "new-cohort", "delete-cohort", "exit") and \
+                len(self.opened) < 100:
+            self.count += 1
+            port = self.rng.randrange(1024, 65535)
+            return "open", f"open {self.name}x{self.count} 100 127.0.0.1 {port} {port + 1}"
+        return "get", f"get c{self.rng.randrange(self.args.customers)}"
+
+    def send(self, mix, addr):
+        self.command, self.request = self.next_request(mix)
+        self.sent_at = time.perf_counter()
+        self.sock.sendto(self.request.encode(), addr)
+
+    # keep track of the customers the request changed
+    def done(self, response):
+        if response.get("res") != "SUCCESS":
+            return False
+
+        tokens = self.request.split()
+        if self.command == "open":
+            self.opened.append(tokens[1])
+        elif self.command == "new-cohort":
+            self.in_cohort.append(tokens[1])
+        elif self.command == "delete-cohort":
+            self.in_cohort.remove(tokens[1])
+        elif self.command == "exit":
+            self.opened.remove(tokens[1])
+            if tokens[1] in self.in_cohort:
+                self.in_cohort.remove(tokens[1])
+        return True
+
+
+def drive(index, clients, args, mix, results):
+    rng = random.Random(args.seed * 1000 + index)
+    addr = ("127.0.0.1", Bank.PORT)
+    selector = selectors.DefaultSelector()
+    latencies = {command: [] for command in COMMANDS}
+    failures = dict.fromkeys(COMMANDS, 0)
+    lost = dict.fromkeys(COMMANDS, 0)
+
+    peers = [Client(f"l{index}x{i}", args, rng) for i in range(clients)]
+    for client in peers:
+        client.new_socket(selector)
+        client.send(mix, addr)
+
+    deadline = time.perf_counter() + args.duration
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+
+        for key, events in selector.select(min(args.timeout, deadline - now)):
+            client = key.data
+            try:
+                data = client.sock.recv(65535)
+            except BlockingIOError:
+                continue
+            latencies[client.command].append(time.perf_counter() - client.sent_at)
+            if not client.done(json.loads(data)):
+                failures[client.command] += 1
+            client.send(mix, addr)
+
+        now = time.perf_counter()
+        for client in peers:
+            if now - client.sent_at > args.timeout:
+                lost[client.command] += 1
+                client.new_socket(selector)
+                client.send(mix, addr)
+
+    results.put((latencies, failures, lost))
+
+
+# value below which the given fraction of the sorted values lie
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summary(latencies, failures, lost, duration):
+    latencies = sorted(latency * 1e3 for latency in latencies)
+    replies = len(latencies)
+    sent = replies + lost
+    return {
+        "sent": sent,
+        "replies": replies,
+        "failures": failures,
+        "lost": lost,
+        "loss_rate": lost / sent if sent else 0,
+        "per_second": replies / duration,
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "p999_ms": percentile(latencies, 0.999)
+    }
+
+
+# send a command to the bank, None if it does not answer in time
+def ask(command, timeout):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(command.encode(), ("127.0.0.1", Bank.PORT))
+        try:
+            return json.loads(sock.recvfrom(65535)[0])
+        # refused while the bank has not bound its port yet
+        except (socket.timeout, ConnectionRefusedError):
+            return None
+
+
+def start_bank(args, directory):
+    rows = [[f"c{i}", "100", "127.0.0.1", str(1024 + i % 60000), str(1025 + i % 60000), 0]
+            for i in range(args.customers)]
+    write_customers_file(rows, os.path.join(directory, Bank.CUSTOMER_FILE_NAME))
+    write_cohort_number(1, os.path.join(directory, Bank.COHORT_NUMBER_FILE_NAME))
+
+    command = [sys.executable, BANK, "--sync", args.sync]
+    if args.asyncio:
+        command.append("--asyncio")
+    if args.workers > 1:
+        command += ["--workers", str(args.workers)]
+    server = subprocess.Popen(command, cwd=directory)
+
+    # wait until it serves
+    started = time.monotonic()
+    while ask("stats", 0.2) is None:
+        if server.poll() is not None or time.monotonic() - started > 60:
+            server.kill()
+            raise RuntimeError("the bank did not start")
+    return server
+
+
+def run(args):
+    mix = parse_mix(args.mix)
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_bank(args, directory)
+        try:
+            results = multiprocessing.Queue()
+            shares = [args.clients // args.processes + (i < args.clients % args.processes)
+                      for i in range(args.processes)]
+            processes = [multiprocessing.Process(target=drive,
+                                                 args=(i, share, args, mix, results))
+                         for i, share in enumerate(shares) if share]
+            for process in processes:
+                process.start()
+            collected = [results.get() for process in processes]
+            for process in processes:
+                process.join()
+            bank_stats = ask("stats", 1)
+        finally:
+            server.terminate()
+            server.wait()
+
+    commands = {}
+    for command in COMMANDS:
+        commands[command] = summary(
+            [latency for latencies, failures, lost in collected for latency in latencies[command]],
+            sum(failures[command] for latencies, failures, lost in collected),
+            sum(lost[command] for latencies, failures, lost in collected),
+            args.duration)
+    total = summary(
+        [latency for latencies, failures, lost in collected
+         for command in COMMANDS for latency in latencies[command]],
+        sum(sum(failures.values()) for latencies, failures, lost in collected),
+        sum(sum(lost.values()) for latencies, failures, lost in collected),
+        args.duration)
+
+    return {
+        "config": dict(vars(args), mix=mix),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "total": total,
+        "commands": commands,
+        "bank": bank_stats and bank_stats.get("data")
+    }
+
+
+def print_report(report):
+    print(f"{'command':>14} {'sent':>8} {'ops/s':>9} {'fail':>6} {'lost':>6} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8}")
+    rows = list(report["commands"].items()) + [("total", report["total"])]
+    for command, result in rows:
+        if not result["sent"]:
+            continue
+        latencies = [f"{result[key]:>8.3f}" if result[key] is not None else f"{'-':>8}"
+                     for key in ("p50_ms", "p99_ms", "p999_ms")]
+        print(f"{command:>14} {result['sent']:>8} {result['per_second']:>9.0f} "
+              f"{result['failures']:>6} {result['lost']:>6} " + " ".join(latencies))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--customers", type=int, default=10000,
+                        help="customers in the database before the run")
+    parser.add_argument("--clients", type=int, default=32,
+                        help="simulated clients, each with one request in flight")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="processes the clients are spread over")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--mix", default=MIX, help="weights of the commands")
+    parser.add_argument("--cohort", type=int, default=3, help="size of the new cohorts")
+    parser.add_argument("--timeout", type=float, default=1,
+                        help="seconds before a request is counted as lost")
+    parser.add_argument("--sync", choices=Bank.SYNC_MODES, default="fsync")
+    parser.add_argument("--asyncio", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", metavar="JSON", help="write the report to a json file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
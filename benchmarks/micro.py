@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import encode_response, read_csv_file, write_customers_file  # noqa: E402
+from customer import CheckpointAndRollback, Customer  # noqa: E402
+from common import close_bank, make_bank, make_rows  # noqa: E402
+
+# microbenchmarks of the hot functions of bank.py and customer.py, each at
+# several data sizes. every benchmark is run REPEAT times and the fastest
+# run is kept, as the time per call in microseconds.
+# --save FILE stores the results as a baseline, --baseline FILE compares
+# against one and exits with status 1 if a benchmark got slower than the
+# baseline by more than --threshold (a fraction, 0.2 by default).
+# usage: python benchmarks/micro.py [--quick] [--only NAME] [--save FILE | --baseline FILE]
+
+REPEAT = 5
+THRESHOLD = 0.2
+
+SIZES = {
+    "bank": [1_000, 10_000, 100_000],
+    "csv": [1_000, 10_000, 100_000],
+    "cohort": [10, 100, 1_000],
+    "get": [10, 100],
+}
+QUICK_SIZES = {
+    "bank": [1_000],
+    "csv": [1_000],
+    "cohort": [10],
+    "get": [10],
+}
+
+
+def make_customer(size):
+    customer = Customer()
+    customer.initialized = True
+    customer.name = "c0"
+    customer.balance = 1000.0
+    customer.cohort = [{"name": f"c{i}", "ipv4": "127.0.0.1", "port2": 1024 + i}
+                       for i in range(size)]
+    customer.chk_rollback = CheckpointAndRollback(customer)
+    # every other member has sent to this customer
+    for i, label in enumerate(customer.chk_rollback.labels.values()):
+        label.last_recv = i % 2
+    return customer
+
+
+# time calls of fn(i) for i in range(number), returns the fastest run in
+# microseconds per call. setup(), if given, runs before every run
+def measure(fn, number, setup=None):
+    best = None
+    for run in range(REPEAT):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for i in range(number):
+            fn(i)
+        elapsed = (time.perf_counter() - start) / number * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_csv(size, directory):
+    filepath = os.path.join(directory, "customers.csv")
+    rows = make_rows(size)
+    write_customers_file(rows, filepath)
+    number = max(1, 10_000 // size)
+    return {
+        "read_csv_file": measure(lambda i: read_csv_file(filepath), number),
+        "write_customers_file": measure(lambda i: write_customers_file(rows, filepath), number),
+    }
+
+
+def bench_bank(size, directory):
+    bank = make_bank(size, directory)
+    number = 300
+    results = {"Bank.get": measure(lambda i: bank.get(f"get c{i}", None), number)}
+
+    # every run forms cohorts with new-cohort, then dissolves them with
+    # delete-cohort. the requesters are not registered, so that no
+    # requester is already in a cohort: new-cohort then draws all of the
+    # members, and delete-cohort is sent for the first of them
+    members = {}
+
+    def new_cohort(i):
+        response = bank.new_cohort(f"new-cohort r{i} 3", None)
+        members[i] = response["data"][0][0]
+
+    def delete_cohort(i):
+        assert bank.delete_cohort(f"delete-cohort {members[i]}", None)["res"] == "SUCCESS"
+
+    # the changes are never committed, they are dropped between runs
+    def dissolve_all():
+        for cohort in list(bank.customers.cohorts):
+            bank.customers.dissolve(cohort)
+        bank.customers.take_changes()
+
+    def fill():
+        dissolve_all()
+        for i in range(number):
+            new_cohort(i)
+
+    results["Bank.new_cohort"] = measure(new_cohort, number, setup=dissolve_all)
+    results["Bank.delete_cohort"] = measure(delete_cohort, number, setup=fill)
+    close_bank(bank)
+    return results
+
+
+# "get" and the encoding of its response for the members of cohorts of the
+# given size, every member polling in turn, with and without the cohort cache
+def bench_get(size, directory):
+    bank = make_bank(size * 10, directory)
+    names = []
+    for i in range(10):
+        names += [row[0] for row in bank.new_cohort(f"new-cohort r{i} {size}", None)["data"]]
+    bank.commit()
+
+    def get(i):
+        encode_response(bank.get(f"get {names[i % len(names)]}", None))
+
+    number = 1000
+    results = {"Bank.get+encode (cached)": measure(get, number)}
+    # nothing stays cached
+    bank.get_cache.size = 0
+    bank.get_cache.entries.clear()
+    results["Bank.get+encode (uncached)"] = measure(get, number)
+    close_bank(bank)
+    return results
+
+
+def bench_cohort(size, directory):
+    customer = make_customer(size)
+    chk = customer.chk_rollback
+    number = max(10, 10_000 // size)
+
+    def transfer_recv(i):
+        customer.transfer_recv(f"transfer 1 c0 {i} c{1 + i % (size - 1)}", None)
+
+    cwd = os.getcwd()
+    os.chdir(directory)   # the checkpoint file goes to the working directory
+    try:
+        results = {
+            "CheckpointAndRollback.initialize_labels": measure(
+                lambda i: chk.initialize_labels(customer.name, customer.cohort), number),
+            "CheckpointAndRollback.update_check_cohort": measure(
+                lambda i: chk.update_check_cohort(), number),
+            "CheckpointAndRollback.write_checkpoint_to_file": measure(
+                lambda i: chk.write_checkpoint_to_file(), number),
+            "Customer.transfer_recv": measure(transfer_recv, 1000),
+        }
+    finally:
+        os.chdir(cwd)
+    customer.sock.close()
+    return results
+
+
+BENCHES = {"csv": bench_csv, "bank": bench_bank, "cohort": bench_cohort, "get": bench_get}
+
+
+# results keyed "<function>/<size>"
+def run(sizes, only=None):
+    results = {}
+    for kind, bench in BENCHES.items():
+        for size in sizes[kind]:
+            with tempfile.TemporaryDirectory() as directory:
+                for name, us in bench(size, directory).items():
+                    if only is None or only in name:
+                        results[f"{name}/{size}"] = us
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="smallest sizes only")
+    parser.add_argument("--only", metavar="NAME",
+                        help="only report the benchmarks whose name contains NAME")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against a baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="slowdown over the baseline counted as a regression")
+    args = parser.parse_args()
+
+    results = run(QUICK_SIZES if args.quick else SIZES, args.only)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    regressions = []
+    for key, us in results.items():
+        line = f"{key:<56} {us:>12.2f}us"
+        if key in baseline:
+            change = us / baseline[key] - 1
+            line += f" {baseline[key]:>12.2f}us {change:>+8.1%}"
+            if change > args.threshold:
+                regressions.append(key)
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+        sys.exit(1)
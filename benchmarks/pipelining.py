@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import multiprocessing
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import Bank, write_customers_file, write_cohort_number  # noqa: E402
+from customer import Customer  # noqa: E402
+
+# throughput of "get" from one customer with 1, 4, 16... requests in
+# flight, see Customer.request(). the bank runs in its own process on
+# loopback, in the given sync mode.
+# usage: python benchmarks/pipelining.py [requests] [sync mode]
+
+REQUESTS = 20000
+WINDOWS = (1, 4, 16, 64)
+CUSTOMERS = 10000
+
+
+def serve(directory, sync_mode, port):
+    os.chdir(directory)
+    Bank.IP = "127.0.0.1"
+    Bank.PORT = port
+    Bank(sync_mode=sync_mode).run()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def pipelined(customer, addr, requests, window):
+    in_flight = deque()
+    start = time.perf_counter()
+    for i in range(requests):
+        if len(in_flight) == window:
+            assert in_flight.popleft().result(timeout=5)["res"] == "SUCCESS"
+        in_flight.append(customer.request(addr, f"get c{i % CUSTOMERS}"))
+    for future in in_flight:
+        assert future.result(timeout=5)["res"] == "SUCCESS"
+    return requests / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else REQUESTS
+    sync_mode = sys.argv[2] if len(sys.argv) > 2 else "fsync"
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_customers_file([[f"c{i}", "100", "127.0.0.1", str(1024 + i % 60000),
+                               str(1025 + i % 60000), 0] for i in range(CUSTOMERS)],
+                             os.path.join(directory, Bank.CUSTOMER_FILE_NAME))
+        write_cohort_number(1, os.path.join(directory, Bank.COHORT_NUMBER_FILE_NAME))
+
+        port = free_port()
+        server = multiprocessing.Process(
+            target=serve, args=(directory, sync_mode, port), daemon=True)
+        server.start()
+        time.sleep(1)
+        addr = ("127.0.0.1", port)
+        customer = Customer()
+        try:
+            print(f"{requests} gets, {sync_mode} sync")
+            single = None
+            for window in WINDOWS:
+                ops = pipelined(customer, addr, requests, window)
+                single = single or ops
+                print(f"{window:>3} in flight: {ops:>10.0f} ops/s ({ops / single:.1f}x)")
+        finally:
+            customer.sock.close()
+            server.terminate()
+            server.join()
@@ -0,0 +1,79 @@
+import os
+import sys
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import BalanceIndex, CustomerRecord, CustomerRegistry  # noqa: E402
+
+# memory footprint of the bank's customer registry, with the customers as
+# csv rows of six strings (the old layout) against CustomerRecord, both
+# with every index of CustomerRegistry, so the difference is that of the
+# records and of the keys they share.
+# each layout is measured in its own process, as the growth of the RSS
+# once a registry of the given number of customers is built.
+# usage: python benchmarks/record_memory.py [customers]
+
+CUSTOMERS = 10_000_000
+HOSTS = 1000
+
+
+# the indexes of CustomerRegistry, built the same way over rows: by name,
+# the pool of unassigned customers with their positions, by cohort, by
+# host, and by balance in chunks of BalanceIndex.CHUNK
+class RowRegistry:
+
+    def __init__(self, rows):
+        self.by_name = {row[0]: row for row in rows}
+        self.unassigned = [row for row in self.by_name.values() if row[5] == 0]
+        self.positions = {row[0]: i for i, row in enumerate(self.unassigned)}
+        self.cohorts = {}
+        self.hosts = {}
+        for row in self.by_name.values():
+            if row[5] != 0:
+                self.cohorts.setdefault(row[5], {})[row[0]] = row
+            self.hosts.setdefault(row[2], {})[row[0]] = row
+
+        def key(row):
+            return int(row[1]), row[0]
+
+        ordered = sorted(self.by_name.values(), key=key)
+        chunk = BalanceIndex.CHUNK
+        self.balance_chunks = [ordered[i:i + chunk] for i in range(0, len(ordered), chunk)]
+        self.balance_firsts = [key(each[0]) for each in self.balance_chunks]
+
+
+def build(layout, size):
+    if layout == "rows":
+        return RowRegistry([f"c{i}", "100", f"10.0.{i % HOSTS // 256}.{i % 256}",
+                            str(i % 65536), str((i + 1) % 65536), i // 5 if i % 2 else 0]
+                           for i in range(size))
+    return CustomerRegistry(CustomerRecord.from_row(
+        [f"c{i}", "100", f"10.0.{i % HOSTS // 256}.{i % 256}",
+         str(i % 65536), str((i + 1) % 65536), i // 5 if i % 2 else 0])
+        for i in range(size))
+
+
+def rss():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(layout, size):
+    before = rss()
+    registry = build(layout, size)
+    print(rss() - before)
+    return registry
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        measure(sys.argv[2], int(sys.argv[1]))
+        sys.exit()
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else CUSTOMERS
+    print(f"{size} customers")
+    for layout in ("rows", "records"):
+        used = int(subprocess.check_output(
+            [sys.executable, __file__, str(size), layout]))
+        print(f"{layout:>8}: {used / 1e6:>8.0f} MB, {used / size:>6.0f} bytes per customer")
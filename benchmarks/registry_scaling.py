@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from common import close_bank, make_bank  # noqa: E402
+
+# per-command latency of the bank handlers for growing customer databases.
+# the handlers are called directly (no sockets in the timed path), so the
+# numbers only reflect the cost of the in-memory customer store.
+# usage: python benchmarks/registry_scaling.py [sizes...]
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+COMMANDS = ["open", "get", "new-cohort", "delete-cohort", "exit"]
+ROUNDS = 2000
+
+
+# run one command per round and return the mean latency in microseconds
+def time_command(bank, make_command):
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        bank_command, data = make_command(i)
+        bank_command(data, None)
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def bench(size):
+    with tempfile.TemporaryDirectory() as directory:
+        bank = make_bank(size, directory)
+        results = {
+            "open": time_command(bank, lambda i: (
+                bank.open, f"open new{i} 100 127.0.0.1 {i} {i + 1}")),
+            "get": time_command(bank, lambda i: (
+                bank.get, f"get c{i}")),
+            "new-cohort": time_command(bank, lambda i: (
+                bank.new_cohort, f"new-cohort new{i} 3")),
+            "delete-cohort": time_command(bank, lambda i: (
+                bank.delete_cohort, f"delete-cohort new{i}")),
+            "exit": time_command(bank, lambda i: (
+                bank.exit, f"exit new{i}")),
+        }
+        close_bank(bank)
+    return results
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f"{'customers':>10} " +
+          " ".join(f"{name:>14}" for name in COMMANDS))
+    for size in sizes:
+        results = bench(size)
+        print(f"{size:>10} " +
+              " ".join(f"{us:>12.1f}us" for us in results.values()))
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import (CustomerRecord, load_database, write_customers_file,  # noqa: E402
+                  write_cohort_number)
+from snapshot import write_snapshot_file  # noqa: E402
+from storage import JournalStorage, SQLiteStorage  # noqa: E402
+
+# cold start of the bank's database from the csv files against the binary
+# snapshot and an SQLite database, including building the customer registry.
+# usage: python benchmarks/snapshot_load.py [customers]
+
+CUSTOMERS = 1_000_000
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else CUSTOMERS
+    rows = [CustomerRecord(f"c{i}", 100, "10.0.0.1", i % 65536, (i + 1) % 65536,
+                           i // 5 if i % 2 else 0) for i in range(size)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        csv_file = os.path.join(directory, "customers.csv")
+        cohort_number_file = os.path.join(directory, "cohort_number.txt")
+        snapshot_file = os.path.join(directory, "customers.snap")
+        journal_file = os.path.join(directory, "customers.journal")
+        database_file = os.path.join(directory, "customers.db")
+
+        write_customers_file(rows, csv_file)
+        write_cohort_number(size, cohort_number_file)
+        write_snapshot_file([c.fields() for c in rows], size, snapshot_file)
+        del rows
+        # seeded from the csv files
+        seed = SQLiteStorage(database_file, csv_file, cohort_number_file)
+        seed.load()
+        seed.close()
+
+        print(f"{size} customers")
+        for name, path in (("csv", csv_file), ("snapshot", snapshot_file),
+                           ("sqlite", database_file)):
+            if name == "sqlite":
+                storage = SQLiteStorage(database_file, csv_file, cohort_number_file)
+            else:
+                storage = JournalStorage(
+                    snapshot_file if name == "snapshot" else snapshot_file + ".missing",
+                    csv_file, cohort_number_file, journal_file, 0)
+            start = time.perf_counter()
+            customers, cohort_number = load_database(storage)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>9}: {os.path.getsize(path) / 1e6:>6.1f} MB, "
+                  f"loaded in {elapsed:.2f}s")
+            del customers
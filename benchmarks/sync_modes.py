@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import json
+import socket
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import Bank, write_customers_file, write_cohort_number  # noqa: E402
+
+# throughput of mutating commands for each storage and sync mode.
+# the bank runs in its own process on loopback, the client keeps WINDOW
+# "open" requests in flight so that group commit has something to group.
+# usage: python benchmarks/sync_modes.py [requests] [window]
+
+REQUESTS = 5000
+WINDOW = 32
+
+
+def serve(directory, storage, sync_mode, port):
+    os.chdir(directory)
+    Bank.IP = "127.0.0.1"
+    Bank.PORT = port
+    Bank(sync_mode=sync_mode, storage=storage).run()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def drive(port, requests, window):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5)
+    addr = ("127.0.0.1", port)
+    sent = received = 0
+
+    start = time.perf_counter()
+    while received < requests:
+        while sent < requests and sent - received < window:
+            sock.sendto(
+                f"open c{sent} 100 127.0.0.1 {sent} {sent + 1}".encode(), addr)
+            sent += 1
+        response = json.loads(sock.recvfrom(Bank.BUFFER_SIZE)[0])
+        assert response["res"] == "SUCCESS"
+        received += 1
+    elapsed = time.perf_counter() - start
+
+    sock.close()
+    return requests / elapsed
+
+
+def bench(storage, sync_mode, requests, window):
+    with tempfile.TemporaryDirectory() as directory:
+        write_customers_file([], os.path.join(
+            directory, Bank.CUSTOMER_FILE_NAME))
+        write_cohort_number(1, os.path.join(
+            directory, Bank.COHORT_NUMBER_FILE_NAME))
+
+        port = free_port()
+        server = multiprocessing.Process(
+            target=serve, args=(directory, storage, sync_mode, port), daemon=True)
+        server.start()
+        time.sleep(0.5)
+        try:
+            return drive(port, requests, window)
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else REQUESTS
+    window = int(sys.argv[2]) if len(sys.argv) > 2 else WINDOW
+    for storage in Bank.STORAGES:
+        for sync_mode in Bank.SYNC_MODES:
+            ops = bench(storage, sync_mode, requests, window)
+            print(f"{storage:>7} {sync_mode:>6}: {ops:>10.0f} ops/s")
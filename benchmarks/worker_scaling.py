@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import json
+import socket
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bank import Bank, write_customers_file, write_cohort_number  # noqa: E402
+
+# throughput of the multi-process bank against the number of workers.
+# the bank is started with "bank.py --workers N" on loopback and CLIENTS
+# client processes, each on its own source port so that SO_REUSEPORT
+# spreads them over the workers, send "get" and "open" requests with
+# WINDOW requests in flight for DURATION seconds.
+# usage: python benchmarks/worker_scaling.py [max workers]
+
+CUSTOMERS = 10000
+CLIENTS = 8
+WINDOW = 16
+DURATION = 5
+BANK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bank.py")
+
+
+def client(index, results):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(1)
+    addr = ("127.0.0.1", Bank.PORT)
+    sent = received = 0
+
+    deadline = time.monotonic() + DURATION
+    while time.monotonic() < deadline:
+        while sent - received < WINDOW:
+            if sent % 10 == 0:
+                command = f"open w{index}x{sent} 100 127.0.0.1 1 2"
+            else:
+                command = f"get c{(index * 7919 + sent) % CUSTOMERS}"
+            sock.sendto(command.encode(), addr)
+            sent += 1
+        try:
+            json.loads(sock.recvfrom(65535)[0])
+        except socket.timeout:
+            sent = received     # count the window as lost and refill it
+            continue
+        received += 1
+
+    results.put(received)
+    sock.close()
+
+
+def bench(workers):
+    with tempfile.TemporaryDirectory() as directory:
+        rows = [[f"c{i}", "100", "127.0.0.1", str(2 * i), str(2 * i + 1), 0]
+                for i in range(CUSTOMERS)]
+        write_customers_file(rows, os.path.join(
+            directory, Bank.CUSTOMER_FILE_NAME))
+        write_cohort_number(1, os.path.join(
+            directory, Bank.COHORT_NUMBER_FILE_NAME))
+
+        server = subprocess.Popen([sys.executable, BANK, "--workers", str(workers),
+                                   "--sync", "async"], cwd=directory)
+        time.sleep(2)
+        try:
+            results = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=client, args=(i, results))
+                       for i in range(CLIENTS)]
+            for each in clients:
+                each.start()
+            total = sum(results.get() for each in clients)
+            for each in clients:
+                each.join()
+        finally:
+            server.terminate()
+            server.wait()
+    return total / DURATION
+
+
+if __name__ == "__main__":
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    for workers in range(1, max_workers + 1):
+        print(f"{workers:>3} workers: {bench(workers):>10.0f} ops/s")
@@ -1,15 +1,31 @@
 import socket
 import math
 import json
+import time
+import heapq
+import random
+import itertools
+import asyncio
+import argparse
 import threading
 from threading import Lock
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 import uuid
 import csv
 import sys
 
+from profiling import Profiler
+import wire
+
 
 class CheckpointAndRollback:
     CHECKPOINT_FILE_NAME = "checkpoint.csv"
+    # seconds a round waits for the replies of the members, the members
+    # not answering by then fail it. a member runs its own rounds before
+    # it replies, this covers those too. a member that the retransmissions
+    # of its request gave up on fails it earlier, see Customer.gather()
+    ROUND_TIMEOUT = 5
 
     def __init__(self, customer) -> None:
         self.labels = self.initialize_labels(customer.name, customer.cohort)
@@ -91,78 +107,65 @@ class CheckpointAndRollback:
                 return (addr, port2)
         return (None, None)
 
-    def send_take_a_tentative_checkpoint(self):
+    # send a command to every member of a cohort at once, the command for
+    # each made by message(name), and gather the replies under
+    # ROUND_TIMEOUT. a round takes about one round trip however large
+    # the cohort. returns whether every member succeeded.
+    # a vote stops at the first member that refuses or goes silent, the
+    # answers of the others no longer matter. the other rounds wait for
+    # every member, so that their requests keep being retransmitted
+    async def send_round(self, cohort, message, vote=False):
+        futures = [self.customer.request(self.get_ipv4_and_port(other_client_name),
+                                         message(other_client_name))
+                   for other_client_name in cohort]
+        answers = await self.customer.gather(futures, CheckpointAndRollback.ROUND_TIMEOUT,
+                                             fail_fast=vote)
+        return all(msg["res"] == "SUCCESS" for msg in answers)
+
+    async def send_take_a_tentative_checkpoint(self):
         cmd = "take-a-tentative-checkpoint"
-        answers = []
 
         self.update_check_cohort()
-        for other_client_name in self.check_cohort:
-            ipv4_port2 = self.get_ipv4_and_port(other_client_name)
-            last_label_recvd = self.labels[other_client_name].last_recv
-
-            msg = self.customer.send(
-                ipv4_port2, f"{cmd} {self.myName} {last_label_recvd} {self.checkpoint_id}")
-            if msg["res"] == "SUCCESS":
-                answers.append(True)
-            else:
-                answers.append(False)
+        return await self.send_round(self.check_cohort, lambda other_client_name: (
+            f"{cmd} {self.myName} {self.labels[other_client_name].last_recv} "
+            f"{self.checkpoint_id}"), vote=True)
 
-        return all(answers)
-
-    def send_make_tentative_check_permanent(self):
+    async def send_make_tentative_check_permanent(self):
         cmd = "make-tentative-checkpoint-permanent"
-        answers = []
 
         self.executed_make_permanent_checkpoint = True
 
         self.update_check_cohort()
-        for other_client_name in self.check_cohort:
-            ipv4_port2 = self.get_ipv4_and_port(other_client_name)
-
-            msg = self.customer.send(ipv4_port2, f"{cmd} {self.checkpoint_id}")
-            if msg["res"] == "SUCCESS":
-                answers.append(True)
-            else:
-                answers.append(False)
-
         # If false, an error happened
-        return all(answers)
+        return await self.send_round(self.check_cohort,
+                                     lambda other_client_name: f"{cmd} {self.checkpoint_id}")
 
-    def send_undo_tentative_checkpoint(self):
+    async def send_undo_tentative_checkpoint(self):
         cmd = "undo-tentative-checkpoint"
-        answers = []
 
         self.update_check_cohort()
-        for other_client_name in self.check_cohort:
-            ipv4_port2 = self.get_ipv4_and_port(other_client_name)
-
-            msg = self.customer.send(ipv4_port2, f"{cmd} {self.checkpoint_id}")
-            if msg["res"] == "SUCCESS":
-                answers.append(True)
-            else:
-                answers.append(False)
-
         # If false, an error happened
-        return all(answers)
+        return await self.send_round(self.check_cohort,
+                                     lambda other_client_name: f"{cmd} {self.checkpoint_id}")
 
-    def checkpoint(self):
+    async def checkpoint(self):
         self.update_check_cohort()
         self.checkpoint_id = str(uuid.uuid4())
         self.has_tentative_checkpoint = True
-        all_success = self.send_take_a_tentative_checkpoint()
+        all_success = await self.send_take_a_tentative_checkpoint()
 
         if not all_success:
-            self.send_undo_tentative_checkpoint()
+            await self.send_undo_tentative_checkpoint()
             return {"res": "FAILURE", "reason": "take a tentative checkpoint failed"}
 
-        all_success = self.send_make_tentative_check_permanent()
+        all_success = await self.send_make_tentative_check_permanent()
         if all_success:
             self.write_checkpoint_to_file()
             return {"res": "SUCCESS"}
         else:
             return {"res": "FAILURE", "reason": "make tentative checkpoint permanent failed"}
 
-    def recv_take_a_tentative_checkpoint(self, data):
+    async def recv_take_a_tentative_checkpoint(self, data):
         tokens = data.split()
         command = tokens[0]
         initializer = tokens[1]
@@ -184,7 +187,7 @@ class CheckpointAndRollback:
 
         if self.willing_to_checkpoint and (value_without_offset >= self.labels[initializer].first_sent > 0):
             self.has_tentative_checkpoint = True
-            all_success = self.send_take_a_tentative_checkpoint()
+            all_success = await self.send_take_a_tentative_checkpoint()
             if all_success:
                 return {"res": "SUCCESS"}
             else:
@@ -192,7 +195,7 @@ class CheckpointAndRollback:
 
         return {"res": "FAILURE", "reason": "members of checkpoint cohort not willing to checkpoint"}
 
-    def recv_make_tentative_checkpoint_permanent(self, data):
+    async def recv_make_tentative_checkpoint_permanent(self, data):
         tokens = data.split()
         command = tokens[0]
         parent_checkpoint_id = tokens[1]
@@ -206,7 +209,7 @@ class CheckpointAndRollback:
 
         self.permanent_checkpoint = True
         self.has_tentative_checkpoint = False
-        all_success = self.send_make_tentative_check_permanent()
+        all_success = await self.send_make_tentative_check_permanent()
         if all_success:
             self.write_checkpoint_to_file()
             self.customer.chk_rollback = CheckpointAndRollback(self.customer)
@@ -214,7 +217,7 @@ class CheckpointAndRollback:
         else:
             return {"res": "FAILURE", "reason": "members of checkpoint cohort not willing to make tentative checkpoint permanent"}
 
-    def recv_undo_tentative_checkpoint(self, data):
+    async def recv_undo_tentative_checkpoint(self, data):
         tokens = data.split()
         command = tokens[0]
         parent_checkpoint_id = tokens[1]
@@ -226,84 +229,56 @@ class CheckpointAndRollback:
 
         self.has_tentative_checkpoint = False
         self.permanent_checkpoint = False
-        all_success = self.send_undo_tentative_checkpoint()
+        all_success = await self.send_undo_tentative_checkpoint()
         if all_success:
             return {"res": "SUCCESS"}
         else:
             return {"res": "FAILURE", "reason": "members of checkpoint cohort not willing to undo tentative checkpoint"}
 
-    def send_prepare_to_rollback(self):
+    async def send_prepare_to_rollback(self):
         cmd = "prepare-to-rollback"
-        answers = []
 
         self.update_rollback_cohort()
-        for other_client_name in self.roll_cohort:
-            ipv4_port2 = self.get_ipv4_and_port(other_client_name)
-            last_label_sent = self.labels[other_client_name].last_sent
-
-            msg = self.customer.send(
-                ipv4_port2, f"{cmd} {self.myName} {last_label_sent} {self.rollback_id}")
-            if msg["res"] == "SUCCESS":
-                answers.append(True)
-            else:
-                answers.append(False)
-
-        return all(answers)
+        return await self.send_round(self.roll_cohort, lambda other_client_name: (
+            f"{cmd} {self.myName} {self.labels[other_client_name].last_sent} "
+            f"{self.rollback_id}"), vote=True)
 
-    def send_rollback(self):
+    async def send_rollback(self):
         cmd = "send-rollback"
-        answers = []
 
         self.executed_make_permanent_rollback = True
 
         self.update_rollback_cohort()
-        for other_client_name in self.roll_cohort:
-            ipv4_port2 = self.get_ipv4_and_port(other_client_name)
-
-            msg = self.customer.send(ipv4_port2, f"{cmd} {self.rollback_id}")
-            if msg["res"] == "SUCCESS":
-                answers.append(True)
-            else:
-                answers.append(False)
-
         # If false, an error happened
-        return all(answers)
+        return await self.send_round(self.roll_cohort,
+                                     lambda other_client_name: f"{cmd} {self.rollback_id}")
 
-    def send_do_not_rollback(self):
+    async def send_do_not_rollback(self):
         cmd = "do-not-rollback"
-        answers = []
 
         self.update_check_cohort()
-        for other_client_name in self.roll_cohort:
-            ipv4_port2 = self.get_ipv4_and_port(other_client_name)
-
-            msg = self.customer.send(ipv4_port2, f"{cmd} {self.rollback_id}")
-            if msg["res"] == "SUCCESS":
-                answers.append(True)
-            else:
-                answers.append(False)
-
         # If false, an error happened
-        return all(answers)
+        return await self.send_round(self.roll_cohort,
+                                     lambda other_client_name: f"{cmd} {self.rollback_id}")
 
-    def rollback(self):
+    async def rollback(self):
         self.rollback_id = str(uuid.uuid4())
         self.has_prepare_rollback = True
-        all_success = self.send_prepare_to_rollback()
+        all_success = await self.send_prepare_to_rollback()
 
         if not all_success:
-            self.send_do_not_rollback()
+            await self.send_do_not_rollback()
             self.has_prepare_rollback = False
             return {"res": "FAILURE", "reason": "send-prepare-to-rollback failed"}
 
-        all_success = self.send_rollback()
+        all_success = await self.send_rollback()
         if all_success:
             self.rollback_from_file()
             return {"res": "SUCCESS"}
         else:
             return {"res": "FAILURE", "reason": "send-rollback failed"}
 
-    def recv_prepare_to_rollback(self, data):
+    async def recv_prepare_to_rollback(self, data):
         tokens = data.split()
         command = tokens[0]
         initializer = tokens[1]
@@ -330,7 +305,7 @@ class CheckpointAndRollback:
             self.has_prepare_rollback = True
             self.resume_execution = False
 
-            all_success = self.send_prepare_to_rollback()
+            all_success = await self.send_prepare_to_rollback()
             if all_success:
                 return {"res": "SUCCESS"}
             else:
@@ -340,7 +315,7 @@ class CheckpointAndRollback:
         
         return {"res": "SUCCESS"}
 
-    def recv_rollback(self, data):
+    async def recv_rollback(self, data):
         tokens = data.split()
         command = tokens[0]
         parent_rollback_id = tokens[1]
@@ -355,7 +330,7 @@ class CheckpointAndRollback:
         self.permanent_rollback = True
         self.has_prepare_rollback = False
         self.executed_make_permanent_rollback = True
-        all_success = self.send_rollback()
+        all_success = await self.send_rollback()
         if all_success:
             self.rollback_from_file()
             self.customer.chk_rollback = CheckpointAndRollback(self.customer)
@@ -363,7 +338,7 @@ class CheckpointAndRollback:
         else:
             return {"res": "FAILURE", "reason": "recv_rollback(): send_rollback() failed"}
 
-    def recv_do_not_rollback(self, data):
+    async def recv_do_not_rollback(self, data):
         tokens = data.split()
         command = tokens[0]
         parent_rollback_id = tokens[1]
@@ -376,13 +351,34 @@ class CheckpointAndRollback:
         self.resume_execution = True
         self.has_prepare_rollback = False
         self.permanent_rollback = False
-        all_success = self.send_do_not_rollback()
+        all_success = await self.send_do_not_rollback()
         if all_success:
             return {"res": "SUCCESS"}
         else:
             return {"res": "FAILURE", "reason": "recv_do_not_rollback(): send_do_not_rollback() failed"}
 
 
+# split commands into "batch" datagrams of the bank, see Customer.send_batch
+# room is left for the request id they are sent with
+def pack_batch(commands):
+    limit = Customer.MAX_DATAGRAM - len(f"req {2 ** 64 - 1} ")
+    batches = []
+    batch = b"batch"
+    count = 0
+    for command in commands:
+        line = b"\n" + command.encode()
+        if count and (count == Customer.BATCH_MAX_COMMANDS or
+                      len(batch) + len(line) > limit):
+            batches.append(batch)
+            batch = b"batch"
+            count = 0
+        batch += line
+        count += 1
+    if count:
+        batches.append(batch)
+    return batches
+
+
 class Label:
     def __init__(self) -> None:
         self.base = 1
@@ -390,6 +386,58 @@ class Label:
         self.last_sent = 0
         self.last_recv = 0
 
+
+# round trip time estimate of a destination (the bank or a peer) and the
+# retransmission timeout drawn from it, as TCP does (RFC 6298): smoothed
+# rtt and rtt variance, rto = srtt + 4 * rttvar within
+# [RTO_MIN, RTO_MAX], doubled on every timeout. only requests answered
+# without a retransmission are sampled, the reply of a retransmitted one
+# could answer any of its copies
+class PeerStats:
+    def __init__(self) -> None:
+        self.srtt = None
+        self.rttvar = None
+        self.rto = Customer.RTO_INITIAL
+
+        self.requests = 0
+        self.retransmits = 0
+        self.timeouts = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, Customer.RTO_MIN), Customer.RTO_MAX)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, Customer.RTO_MAX)
+
+    def report(self):
+        return {
+            "srtt_ms": None if self.srtt is None else round(self.srtt * 1000, 3),
+            "rttvar_ms": None if self.rttvar is None else round(self.rttvar * 1000, 3),
+            "rto_ms": round(self.rto * 1000, 3),
+            "requests": self.requests,
+            "retransmits": self.retransmits,
+            "timeouts": self.timeouts,
+        }
+
+
+# a request waiting for its reply, see Customer.submit()
+class PendingRequest:
+    __slots__ = ("future", "addr", "message", "sent", "timeout", "retransmits")
+
+    def __init__(self, future, addr, message, sent, timeout):
+        self.future = future
+        self.addr = addr
+        self.message = message
+        self.sent = sent
+        self.timeout = timeout
+        self.retransmits = 0
+
 class Customer:
 
     # assigned port ranges
@@ -398,12 +446,54 @@ class Customer:
     PORT_END = math.ceil(GROUP_NUMBER / 2) * 1000 + 999
 
     BUFFER_SIZE = 1024
+    # largest response to a page of "get", see get_pages(). at most
+    # BUFFER_SIZE; a path MTU of 1500 takes up to 1472 without IP
+    # fragmentation, with BUFFER_SIZE raised to match
+    PAGE_SIZE = 1024
+    # tries of get_pages() when the cohort changes while it is paged through
+    GET_ATTEMPTS = 3
+    # largest UDP payload over IPv4, and the most commands the bank takes
+    # in one batch (Bank.MAX_DATAGRAM, Bank.BATCH_MAX_COMMANDS)
+    MAX_DATAGRAM = 65507
+    BATCH_MAX_COMMANDS = 1000
+    # batches of send_batch() in flight at once. more would only overflow
+    # the receive buffer of the bank
+    BATCH_WINDOW = 2
+    # receive buffer of self.sock, which takes the replies of every request
+    # in flight, a batch reply being several full datagrams. the kernel
+    # caps it at net.core.rmem_max
+    RECEIVE_BUFFER = 4 * 1024 * 1024
 
     PORT = PORT_START
     SERVER_ADDR = ("34.125.18.167", PORT)   # the server's address
 
+    # profiles of the cohort listener, see profile()
+    PROFILE_DURATION = 10
+    PROFILE_MAX_DURATION = 300
+    PROFILE_PREFIX = "customer"
+
+    # retransmission of unanswered requests, see PeerStats. seconds
+    RTO_INITIAL = 1.0
+    RTO_MIN = 0.2
+    RTO_MAX = 10.0
+    # a request retransmitted this many times without a reply fails with
+    # {"res": "FAILURE", "reason": "timed out"}, after 1 + 2 + 4 + 8 times
+    # the rto of its destination
+    MAX_RETRANSMITS = 3
+    # how often the receiver looks for requests to retransmit when no reply
+    # arrives, seconds
+    TIMER_TICK = 0.02
+    # replies of the cohort listener kept for retransmitted requests, which
+    # get them again rather than being run twice
+    REPLY_CACHE_SIZE = 4096
+
+    # send the commands wire.py can encode in binary to the peers that take
+    # it, see send()
+    USE_WIRE = True
+
     def __init__(self) -> None:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # IP/UDP
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, Customer.RECEIVE_BUFFER)
         self.sock = sock
 
         self.initialized = False
@@ -415,20 +505,272 @@ class Customer:
 
         self.chk_rollback = None
 
+        # address the cohort listener is bound to, once it runs
+        self.listen_addr = None
+        self.profiler = Profiler(Customer.PROFILE_PREFIX)
+
+        # addr -> whether the peer takes the binary encoding of wire.py
+        self.wire_peers = {}
+
+        # requests to the bank and to the peers go out of self.sock as
+        # "req <id> <command>", and a single receiver thread hands each
+        # reply to the future of the request with its id. ids start at
+        # random: the bank remembers the replies to the ids of a host for a
+        # while, and another customer on this host or an earlier run of
+        # this one must not be answered from them
+        self.request_ids = itertools.count(random.getrandbits(63))
+        # id -> PendingRequest waiting for its reply
+        self.pending = {}
+        # id -> {part: data} of a reply split over several datagrams
+        self.parts = {}
+        self.receiver = None
+        self.receiver_lock = Lock()
+        # heap of (time, id) of the next retransmission of each request
+        self.timers = []
+        self.timers_lock = Lock()
+        # addr -> PeerStats of each destination
+        self.peers = {}
+
+        # (addr, id) -> reply of the cohort listener, least recent first.
+        # None while the request is still being handled, see PeerProtocol
+        self.replies = OrderedDict()
+        # event loop of the cohort listener, see listen_to_cohort_async()
+        self.loop = None
+
+    # send a command and wait for its response, {"res": "FAILURE", "reason":
+    # "timed out"} if its retransmissions go unanswered
     def send(self, addr, msg):
-        message = str.encode(msg)
-
-        # connect to the server, send a command
+        return self.request(addr, msg).result()
+
+    # send a command, returns the future of its response. any number of
+    # requests may be in flight at once, to any number of peers.
+    # a command goes in the binary encoding of wire.py if it has one and
+    # the peer takes it, as text otherwise. responses come back in the
+    # encoding of their command
+    def request(self, addr, msg):
+        binary = Customer.USE_WIRE and self.speaks_wire(addr)
+        return self.submit(addr, msg, binary)
+
+    # send a command with the next request id and register its future
+    def submit(self, addr, msg, binary=False):
+        self.start_receiver()
+        rid = next(self.request_ids)
+        text = f"req {rid} {msg}"
+        message = wire.encode_request(text) if binary else None
+        if message is None:
+            message = text.encode()
+
+        peer = self.peer_stats(addr)
+        peer.requests += 1
+        future = Future()
+        future.rid = rid
+        request = PendingRequest(future, addr, message, time.monotonic(), peer.rto)
+        self.pending[rid] = request
         self.sock.sendto(message, addr)
+        with self.timers_lock:
+            heapq.heappush(self.timers, (request.sent + request.timeout, rid))
+        return future
+
+    def peer_stats(self, addr):
+        peer = self.peers.get(addr)
+        if peer is None:
+            peer = self.peers.setdefault(addr, PeerStats())
+        return peer
+
+    # rtt estimate and retransmissions of each destination, by "ipv4:port"
+    def report_peers(self):
+        return {f"{addr[0]}:{addr[1]}": peer.report() for addr, peer in self.peers.items()}
+
+    def start_receiver(self):
+        with self.receiver_lock:
+            if self.receiver is None:
+                self.sock.settimeout(Customer.TIMER_TICK)
+                self.receiver = threading.Thread(target=self.receive, daemon=True)
+                self.receiver.start()
+
+    # read the replies arriving on self.sock and resolve the futures of
+    # their requests, and retransmit the requests whose timeout passed.
+    # replies without the id of a pending request (late or repeated) are
+    # dropped, as are the malformed ones
+    def receive(self):
+        while True:
+            try:
+                byte_message, _ = self.sock.recvfrom(Customer.MAX_DATAGRAM)
+                self.resolve(byte_message)
+            except socket.timeout:
+                pass
+            except OSError as e:
+                # the socket was closed
+                if self.sock.fileno() == -1:
+                    return
+                # an error of an earlier datagram, such as the connection
+                # reset that Windows reports after an ICMP port unreachable:
+                # the receiver keeps going, it runs the retransmissions too
+                print(f"receive: {e}", file=sys.stderr)
+            if self.timers and self.timers[0][0] <= time.monotonic():
+                self.retransmit()
+
+    def resolve(self, byte_message):
+        try:
+            if wire.is_binary(byte_message):
+                msg = wire.decode_response(byte_message)
+            else:
+                msg = json.loads(byte_message)
+            rid = msg.pop("id")
+        except Exception:
+            return
+        if rid not in self.pending:
+            return
+
+        # a reply in parts (see Bank's encode_response) is resolved once
+        # they are all in, with their data joined in order
+        if "parts" in msg:
+            parts = self.parts.setdefault(rid, {})
+            parts[msg["part"]] = msg["data"]
+            if len(parts) < msg["parts"]:
+                return
+            del self.parts[rid]
+            msg = {"res": msg["res"],
+                   "data": [each for i in range(len(parts)) for each in parts[i]]}
+
+        request = self.pending.pop(rid, None)
+        if request is None:
+            return
+        if not request.retransmits:
+            self.peer_stats(request.addr).sample(time.monotonic() - request.sent)
+        request.future.set_result(msg)
+
+    # send the requests whose timeout passed again, with twice the timeout,
+    # and fail those retransmitted MAX_RETRANSMITS times already
+    def retransmit(self):
+        now = time.monotonic()
+        while True:
+            with self.timers_lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                deadline, rid = heapq.heappop(self.timers)
+            request = self.pending.get(rid)
+            if request is None:
+                # answered or given up on
+                continue
+
+            peer = self.peer_stats(request.addr)
+            peer.backoff()
+            if request.retransmits == Customer.MAX_RETRANSMITS:
+                self.pending.pop(rid, None)
+                self.parts.pop(rid, None)
+                peer.timeouts += 1
+                request.future.set_result({"res": "FAILURE", "reason": "timed out"})
+                continue
+
+            request.retransmits += 1
+            peer.retransmits += 1
+            request.timeout = min(request.timeout * 2, Customer.RTO_MAX)
+            try:
+                self.sock.sendto(request.message, request.addr)
+            except OSError:
+                pass
+            with self.timers_lock:
+                heapq.heappush(self.timers, (now + request.timeout, rid))
+
+    # the responses of requests in flight, in order, waiting at most
+    # timeout seconds for all of them. requests not answered by then get
+    # {"res": "FAILURE", "reason": "timed out"}, and are no longer
+    # retransmitted. with fail_fast, stops waiting at the first response
+    # that is not a success.
+    # a coroutine, the event loop it runs on serves other work meanwhile
+    async def gather(self, futures, timeout=None, fail_fast=False):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        remaining = {asyncio.wrap_future(future) for future in futures}
+        while remaining:
+            left = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done, remaining = await asyncio.wait(remaining, timeout=left,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            if fail_fast and any(future.result()["res"] != "SUCCESS" for future in done):
+                break
+
+        for future in futures:
+            self.pending.pop(future.rid, None)
+        return [future.result() if future.done() else
+                {"res": "FAILURE", "reason": "timed out"} for future in futures]
+
+    # whether a peer takes our version of the binary encoding, asked with
+    # "hello" the first time. nothing waits for the answer: the peer gets
+    # text until it comes. a peer that does not know "hello" fails it, and
+    # keeps getting text. a peer that does not answer is asked again next
+    # time
+    def speaks_wire(self, addr):
+        if addr not in self.wire_peers:
+            self.wire_peers[addr] = False
+
+            def answered(future):
+                msg = future.result()
+                if msg.get("reason") == "timed out":
+                    self.wire_peers.pop(addr, None)
+                else:
+                    self.wire_peers[addr] = msg["res"] == "SUCCESS" and \
+                        wire.VERSION in msg["data"]["wire"]
+
+            self.submit(addr, "hello").add_done_callback(answered)
+        return self.wire_peers[addr]
+
+    # run several bank commands in as few round trips as possible
+    # the commands are packed into "batch" datagrams, BATCH_WINDOW of them
+    # in flight at once, and the responses are put back together in order.
+    # returns {"res": "SUCCESS", "data": [<response of each command>]}, or
+    # the failure of the first batch the bank refused
+    def send_batch(self, addr, commands):
+        responses = []
+        in_flight = deque()
+        for batch in pack_batch(commands):
+            if len(in_flight) == Customer.BATCH_WINDOW:
+                msg = in_flight.popleft().result()
+                if msg["res"] != "SUCCESS":
+                    return msg
+                responses.extend(msg["data"])
+            in_flight.append(self.submit(addr, batch.decode()))
+
+        for future in in_flight:
+            msg = future.result()
+            if msg["res"] != "SUCCESS":
+                return msg
+            responses.extend(msg["data"])
+
+        return {"res": "SUCCESS", "data": responses}
+
+    # the response of "get" for a customer, fetched a page of page_size bytes
+    # at a time so that a large cohort fits the receive buffer, and put
+    # back together. the pages are fetched again from the start if the size
+    # of the cohort changes in between
+    def get_pages(self, addr, name, page_size=None):
+        page_size = page_size or Customer.PAGE_SIZE
+        for attempt in range(Customer.GET_ATTEMPTS):
+            msg = self.send(addr, f"get {name} 0 {page_size}")
+            if msg["res"] != "SUCCESS":
+                return msg
+
+            response = {"res": "SUCCESS", "data": msg["data"]}
+            cohort = msg["data"]["cohort"]
+            members = msg["members"]
+            while "next" in msg:
+                msg = self.send(addr, f"get {name} {msg['next']} {page_size}")
+                if msg["res"] != "SUCCESS" or msg["members"] != members:
+                    break
+                cohort.extend(msg["data"]["cohort"])
+            else:
+                return response
 
-        # receive any response sent from server
-        byte_message, addr = self.sock.recvfrom(Customer.BUFFER_SIZE)
-        return json.loads(byte_message)
+        return {"res": "FAILURE", "reason": "cohort changed while fetching it"}
 
     def get(self, data):
         if self.initialized:
             return {"res": "FAILURE", "reason": "account already initialized"}
-        msg = customer.send(Customer.SERVER_ADDR, data)
+        tokens = data.split()
+        if len(tokens) != 2:
+            return {"res": "FAILURE"}
+        msg = self.get_pages(Customer.SERVER_ADDR, tokens[1])
         if msg['res'] == 'SUCCESS':
             self.name = msg['data']['name']
             self.balance = float(msg['data']['balance'])
@@ -477,76 +819,78 @@ class Customer:
                 if not emulateLostTransfer:
                     data += f" {self.name}"
                     msg = self.send((ipv4, port2), data)
-                    if msg["res"] == "FAILURE":
+                    # a timeout says nothing of whether the recipient applied
+                    # the transfer, its reply may be the one that got lost:
+                    # the amount is not given back, the checkpoint and
+                    # rollback rounds settle it. a refusal is given back
+                    if msg["res"] == "FAILURE" and msg.get("reason") != "timed out":
                         self.deposit(amount)
-                    else:
-                        return msg
+                    return msg
                 else:
                     return {"res": "SUCCESS", "emulate lost transfer": "True"}
 
         return {"res": "FAILURE", "reason": "recipient not found"}
 
+    # run a checkpoint or rollback round to the end, on the event loop of
+    # the cohort listener if it has one so that it does not race the
+    # handlers, on an event loop of its own otherwise
+    def run_round(self, coroutine):
+        if self.loop is not None:
+            return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        return asyncio.run(coroutine)
+
     def checkpoint(self):
-        msg = self.chk_rollback.checkpoint()
+        msg = self.run_round(self.chk_rollback.checkpoint())
         if msg["res"] == "SUCCESS":
             self.chk_rollback = CheckpointAndRollback(self)
         return msg
 
     def rollback(self):
-        msg = self.chk_rollback.rollback()
+        msg = self.run_round(self.chk_rollback.rollback())
         if msg["res"] == "SUCCESS":
             
             self.chk_rollback = CheckpointAndRollback(self)
         return msg
 
+    # the address of this customer in its cohort, the listener's
+    def own_address(self):
+        for each in self.cohort:
+            if each['name'] == self.name:
+                return (each['ipv4'], each['port2'])
+        return (None, None)
+
+    # serve the cohort from a thread, one command at a time. a checkpoint
+    # or rollback round run by a handler holds the listener until it is
+    # done, see listen_to_cohort_async() for a listener that does not wait
     def listen_to_cohort(self):
         def helper():
-            ipv4 = None
-            port2 = None
-
-            for each in self.cohort:
-                if each['name'] == self.name:
-                    ipv4 = each['ipv4']
-                    port2 = each['port2']
-                    break
-
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # IP/UDP
-            sock.bind((ipv4, port2))
+            sock.bind(self.own_address())
+            self.listen_addr = self.own_address()
 
             while True:
                 data, addr = sock.recvfrom(Customer.BUFFER_SIZE)
-                data = data.decode()
-                response = None
+                binary = wire.is_binary(data)
+                command = None
+                rid = None
 
-                # read commands received from the socket
                 try:
-                    if data.startswith("transfer"):
-                        response = self.transfer_recv(data, addr)
-                    elif data.startswith("take-a-tentative-checkpoint"):
-                        response = self.chk_rollback.recv_take_a_tentative_checkpoint(
-                            data)
-                    elif data.startswith("make-tentative-checkpoint-permanent"):
-                        response = self.chk_rollback.recv_make_tentative_checkpoint_permanent(
-                            data)
-                    elif data.startswith("undo-tentative-checkpoint"):
-                        response = self.chk_rollback.recv_undo_tentative_checkpoint(
-                            data)
-                    elif data.startswith("prepare-to-rollback"):
-                        response = self.chk_rollback.recv_prepare_to_rollback(
-                            data)
-                    elif data.startswith("send-rollback"):
-                        response = self.chk_rollback.recv_rollback(
-                            data)
-                    elif data.startswith("do-not-rolllback"):
-                        response = self.chk_rollback.recv_do_not_rollback(
-                            data)
-                    else:
-                        response = {"res": "FAILURE"}
+                    command, data, binary, rid = self.read_request(data)
+                    # a retransmission gets the reply of the first copy
+                    if rid is not None and (addr, rid) in self.replies:
+                        sock.sendto(self.replies[(addr, rid)], addr)
+                        continue
+
+                    response = self.dispatch(data, addr)
+                    if asyncio.iscoroutine(response):
+                        response = asyncio.run(response)
                 except Exception as e:
                     response = {"res": "FAILURE"}
 
                 # later save checkpoint to a file
-                self.sock.sendto(json.dumps(response).encode(), addr)
+                # replies go out of the listener's socket, self.sock only
+                # carries this customer's own requests and their replies
+                sock.sendto(self.make_reply(addr, command, response, binary, rid), addr)
 
         if not self.initialized:
             return {"res": "FAILURE", "reason": "not initialized"}
@@ -554,6 +898,129 @@ class Customer:
         extra_thread = threading.Thread(target=helper)
         extra_thread.start()
 
+    # serve the cohort with an asyncio event loop, run by a thread of its
+    # own. every handler runs on the loop, and those running checkpoint or
+    # rollback rounds are coroutines awaiting the replies: transfers and
+    # other rounds are served while they wait, nested rounds reaching
+    # this customer again are answered instead of deadlocking on it. the
+    # rounds started with checkpoint() and rollback() run on the loop too
+    def listen_to_cohort_async(self):
+        if not self.initialized:
+            return {"res": "FAILURE", "reason": "not initialized"}
+
+        started = threading.Event()
+        threading.Thread(target=asyncio.run, args=(self.serve_cohort(started),),
+                         daemon=True).start()
+        started.wait()
+
+    async def serve_cohort(self, started):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: PeerProtocol(self), local_addr=self.own_address())
+        self.listen_addr = self.own_address()
+        self.loop = loop
+        started.set()
+        try:
+            await asyncio.Future()  # serve forever
+        finally:
+            transport.close()
+
+    # the command a datagram sent to the listener carries: the name of its
+    # command if it came in the binary encoding of wire.py, the text
+    # command it is or stands for, whether it came in binary, and its
+    # request id, None if it has none
+    def read_request(self, data):
+        binary = wire.is_binary(data)
+        command = None
+        rid = None
+        if binary:
+            command, data = wire.decode_request(data)
+        else:
+            data = data.decode()
+        if data.startswith("req "):
+            tokens = data.split(' ', 2)
+            rid, data = int(tokens[1]), tokens[2]
+        return command, data, binary, rid
+
+    # run a command of the cohort. the handlers running checkpoint and
+    # rollback rounds are coroutines, their coroutine is returned for the
+    # listener to run
+    def dispatch(self, data, addr):
+        if data.startswith("transfer"):
+            return self.transfer_recv(data, addr)
+        elif data.startswith("take-a-tentative-checkpoint"):
+            return self.chk_rollback.recv_take_a_tentative_checkpoint(data)
+        elif data.startswith("make-tentative-checkpoint-permanent"):
+            return self.chk_rollback.recv_make_tentative_checkpoint_permanent(data)
+        elif data.startswith("undo-tentative-checkpoint"):
+            return self.chk_rollback.recv_undo_tentative_checkpoint(data)
+        elif data.startswith("prepare-to-rollback"):
+            return self.chk_rollback.recv_prepare_to_rollback(data)
+        elif data.startswith("send-rollback"):
+            return self.chk_rollback.recv_rollback(data)
+        elif data.startswith("do-not-rollback"):
+            return self.chk_rollback.recv_do_not_rollback(data)
+        elif data.startswith("profile"):
+            return self.profile(data, addr)
+        elif data.startswith("hello"):
+            return {"res": "SUCCESS", "data": {"wire": wire.VERSIONS}}
+        return {"res": "FAILURE"}
+
+    # the reply to a command of the cohort, in the encoding of the command.
+    # replies to requests with an id are kept for their retransmissions
+    def make_reply(self, addr, command, response, binary, rid):
+        if binary:
+            reply = wire.encode_response(command, response, rid)
+        elif rid is not None:
+            reply = json.dumps(dict(response, id=rid)).encode()
+        else:
+            reply = json.dumps(response).encode()
+        if rid is not None:
+            self.replies[(addr, rid)] = reply
+            if len(self.replies) > Customer.REPLY_CACHE_SIZE:
+                self.replies.popitem(last=False)
+        return reply
+
+    # profile the cohort listener, its handlers and the checkpoint and
+    # rollback rounds they run, for a while. see profiling.py
+    # runs on the listener thread, and is only taken from this host
+    # params:
+    #   data: string type, command received by the listener
+    #         string format is "profile [<seconds>]" to start a profile,
+    #         "profile stop" to end it early
+    #   addr: tuple of the sender's addr and port
+    # return:
+    #   on success: {"res": "SUCCESS", "data": {"file": <profile file>}},
+    #               the file is written once the profile ends
+    #   on failure: {"res": "FAILURE", "reason": <reason>}
+    def profile(self, data, addr):
+        tokens = data.split()
+
+        if addr[0] not in ("127.0.0.1", self.listen_addr[0]):
+            return {"res": "FAILURE", "reason": "only taken from this host"}
+
+        if len(tokens) == 2 and tokens[1] == "stop":
+            filepath = self.profiler.stop()
+            if filepath is None:
+                return {"res": "FAILURE", "reason": "no profile is running"}
+            return {"res": "SUCCESS", "data": {"file": filepath}}
+
+        duration = float(tokens[1]) if len(tokens) == 2 else Customer.PROFILE_DURATION
+        if not 0 < duration <= Customer.PROFILE_MAX_DURATION:
+            return {"res": "FAILURE", "reason": "invalid duration"}
+
+        filepath = self.profiler.start(duration, self.stop_profile)
+        if filepath is None:
+            return {"res": "FAILURE", "reason": "a profile is already running"}
+        return {"res": "SUCCESS", "data": {"file": filepath}}
+
+    # end the listener's profile from another thread, by sending it
+    # "profile stop" so that the profile ends on the listener thread
+    def stop_profile(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto(b"profile stop", self.listen_addr)
+        sock.close()
+
     def transfer_recv(self, data, addr):
         tokens = data.split()
         command = tokens[0]
@@ -597,8 +1064,70 @@ class Customer:
             return {"res": "FAILURE", "reason": "not initialized"}
         return ("name: " + self.name + "     balance: " + str(self.balance))
 
+# asyncio front end of the cohort listener, see
+# Customer.listen_to_cohort_async()
+# a command is read and dispatched on the event loop as it arrives. the
+# handlers of transfers and the other plain commands are answered at once,
+# those running checkpoint and rollback rounds go on as tasks and are
+# answered when their rounds are done, so that any number of them can be
+# in flight. a retransmission of a request still in flight is dropped, the
+# next one gets the reply
+class PeerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, customer):
+        self.customer = customer
+        self.transport = None
+        # the tasks of the rounds in flight, referenced until they are done
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        binary = wire.is_binary(data)
+        command = None
+        rid = None
+
+        try:
+            command, data, binary, rid = self.customer.read_request(data)
+            # a retransmission gets the reply of the first copy
+            if rid is not None and (addr, rid) in self.customer.replies:
+                reply = self.customer.replies[(addr, rid)]
+                if reply is not None:
+                    self.transport.sendto(reply, addr)
+                return
+
+            response = self.customer.dispatch(data, addr)
+        except Exception:
+            response = {"res": "FAILURE"}
+
+        if asyncio.iscoroutine(response):
+            if rid is not None:
+                self.customer.replies[(addr, rid)] = None
+            task = asyncio.ensure_future(self.answer(response, addr, command, binary, rid))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            self.transport.sendto(
+                self.customer.make_reply(addr, command, response, binary, rid), addr)
+
+    async def answer(self, coroutine, addr, command, binary, rid):
+        try:
+            response = await coroutine
+        except Exception:
+            response = {"res": "FAILURE"}
+        self.transport.sendto(
+            self.customer.make_reply(addr, command, response, binary, rid), addr)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve the cohort with an asyncio event loop")
+    args = parser.parse_args()
+
     customer = Customer()
+    listen = customer.listen_to_cohort_async if args.asyncio else customer.listen_to_cohort
 
     while True:
         command = input("msg: ")
@@ -606,9 +1135,9 @@ if __name__ == "__main__":
         # iniate threads for peer to peer communication
         if command.startswith("get"):
             msg = customer.get(command)
-            customer.listen_to_cohort()
+            listen()
         elif command.startswith("listen-to-cohort"):
-            customer.listen_to_cohort()
+            listen()
         elif command.startswith("deposit"):
             tokens = command.split()
             amount = int(tokens[1])
@@ -627,6 +1156,18 @@ if __name__ == "__main__":
             msg = customer.rollback()
         elif command.startswith("print-balance"):
             msg = customer.print_balance()
+        elif command.startswith("peer-stats"):
+            msg = customer.report_peers()
+        elif command.startswith("profile"):
+            # handled by the listener, which profiles itself
+            if customer.listen_addr is None:
+                msg = {"res": "FAILURE", "reason": "not listening"}
+            else:
+                msg = customer.send(customer.listen_addr, command)
+        elif command.startswith("batch"):
+            # batch <command>; <command>; ...
+            commands = [each.strip() for each in command[len("batch"):].split(";")]
+            msg = customer.send_batch(Customer.SERVER_ADDR, [each for each in commands if each])
         else:
             msg = customer.send(Customer.SERVER_ADDR, command)
 
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import threading
+
+
+# append-only journal of the bank's mutations
+# every mutation is written as one json record per line and synced to disk
+# (see Bank.SYNC_MODES for when it is synced), so persisting a command costs
+# the same no matter how many customers are registered. the journal is
+# periodically folded into the snapshot of the database (see snapshot.py)
+# by a background thread.
+# records only set state (a full row, a deletion, a cohort number for a list
+# of names), so replaying a record on a state that already contains it is
+# harmless; this is what makes the compaction crash-safe.
+class Journal:
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        # journal set aside while its records are written into a snapshot
+        self.old_filepath = filepath + ".old"
+        self.file = None
+        # set-aside journal whose records are not synced yet, see compact()
+        self.retired = None
+
+        # records written since the last compaction
+        self.records = 0
+        self.compaction = None
+
+        # whether records were written since the last sync. the lock guards
+        # the file against the background flusher of the async mode, it is
+        # not held during an fsync so that writers do not wait on the disk.
+        # syncs wait on each other, so a sync returns once every record
+        # written before it is durable
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+    # yield every record of the set-aside and current journal, oldest first
+    def replay(self):
+        for path in (self.old_filepath, self.filepath):
+            if not os.path.exists(path):
+                continue
+
+            offset = 0
+            with open(path, 'rb') as file:
+                for line in file:
+                    # a crash in the middle of an append leaves a partial
+                    # last line, everything before it is still valid
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    offset += len(line)
+                    self.records += 1
+                    yield record
+
+            # drop the partial line so new records start on a fresh line
+            if path == self.filepath:
+                os.truncate(path, offset)
+
+    # open the journal for appending, after it has been replayed
+    def open(self):
+        self.file = open(self.filepath, 'a')
+
+    def close(self):
+        if self.compaction is not None:
+            self.compaction.join()
+        if self.retired is not None:
+            self.retired.close()
+        self.file.close()
+
+    # write a list of records, they are durable after the next sync()
+    def write(self, records):
+        with self.lock:
+            for record in records:
+                self.file.write(json.dumps(record) + "\n")
+            self.records += len(records)
+            self.dirty = True
+
+    # flush and fsync the records written so far, those of the set-aside
+    # journal first. the fsync runs on a duplicate of the descriptor, the
+    # file may be switched by a compaction meanwhile
+    def sync(self):
+        with self.sync_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                retired, self.retired = self.retired, None
+                self.file.flush()
+                fd = os.dup(self.file.fileno())
+                self.dirty = False
+
+            try:
+                if retired is not None:
+                    os.fsync(retired.fileno())
+                    retired.close()
+                os.fsync(fd)
+            except OSError:
+                # the records are not known to be durable
+                with self.lock:
+                    self.dirty = True
+                raise
+            finally:
+                os.close(fd)
+
+    # durably append a list of records
+    def append(self, records):
+        self.write(records)
+        self.sync()
+
+    # sync the journal every interval seconds from a background thread
+    def sync_periodically(self, interval):
+        def helper():
+            while True:
+                time.sleep(interval)
+                self.sync()
+
+        threading.Thread(target=helper, daemon=True).start()
+
+    # write the full state into a snapshot and start over with an empty
+    # journal. snapshot() copies the state and returns a function writing it.
+    def checkpoint(self, snapshot):
+        snapshot()()
+        if os.path.exists(self.old_filepath):
+            os.remove(self.old_filepath)
+        with self.lock:
+            self.file.truncate(0)
+            self.records = 0
+            self.dirty = False
+
+    # fold the journal into a snapshot in the background.
+    # the current journal is set aside and new records go to a fresh one
+    # while write_snapshot runs; the set-aside journal is deleted once the
+    # snapshot is on disk. returns False if a compaction is still running.
+    def compact(self, snapshot):
+        if self.compaction is not None and self.compaction.is_alive():
+            return False
+
+        # a previous compaction did not finish, write the snapshot now
+        # rather than overwrite the journal it was compacting
+        if os.path.exists(self.old_filepath):
+            self.checkpoint(snapshot)
+            return True
+
+        # the state is copied here, in line with the journal switch.
+        # records not synced yet stay dirty: the set-aside journal is kept
+        # open and synced along with the new one by the next sync(), so
+        # that their replies are not released before them and the caller
+        # does not wait on an fsync here
+        write_snapshot = snapshot()
+        with self.lock:
+            self.file.flush()
+            if self.dirty:
+                self.retired = self.file
+            else:
+                self.file.close()
+            os.replace(self.filepath, self.old_filepath)
+            self.open()
+            self.records = 0
+
+        def helper():
+            write_snapshot()
+            os.remove(self.old_filepath)
+
+        self.compaction = threading.Thread(target=helper, daemon=True)
+        self.compaction.start()
+        return True
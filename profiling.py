@@ -0,0 +1,52 @@
+import os
+import time
+import cProfile
+import threading
+
+
+# bounded cProfile run of a serving loop
+# the profile is written in the standard pstats format, to be read with
+# "python -m pstats <file>" or any tool taking cProfile output.
+# cProfile only sees the thread that enabled it, so start() and stop() are
+# called on the serving thread. when the time is up the timer thread calls
+# wake(), which has to get the serving thread to call stop(): the loops
+# themselves are not hooked, a profiler that is not running costs nothing.
+class Profiler:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.profile = None
+        self.filepath = None
+        self.timer = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    # start profiling the calling thread for the given number of seconds.
+    # returns the file the profile will be written to, or None if a
+    # profile is already running
+    def start(self, duration, wake):
+        if self.profile is not None:
+            return None
+
+        self.filepath = f"{self.prefix}.{os.getpid()}.{time.strftime('%Y%m%d-%H%M%S')}.prof"
+        self.timer = threading.Timer(duration, wake)
+        self.timer.daemon = True
+        self.timer.start()
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self.filepath
+
+    # stop profiling and write the profile out.
+    # returns its file, or None if no profile was running
+    def stop(self):
+        if self.profile is None:
+            return None
+
+        self.profile.disable()
+        self.timer.cancel()
+        self.profile.dump_stats(self.filepath)
+        self.profile = None
+        return self.filepath
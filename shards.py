@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import signal
+import zlib
+import random
+import socket
+import threading
+import multiprocessing
+
+from bank import (Bank, CustomerRecord, get_response, load_database, parse_get,
+                  parse_query, query_response)
+from snapshot import write_snapshot_file
+from storage import JournalStorage
+
+
+# multi-process bank
+# N worker processes bind the bank port with SO_REUSEPORT, so the kernel
+# spreads the clients over them. the customers are partitioned by a hash of
+# their name, and every worker keeps its shard in its own snapshot and
+# journal (customers.<shard>.snap, customers.<shard>.journal).
+#
+# any worker can receive any command. the worker that receives it acts as
+# its coordinator and performs it through small "primitive" operations on
+# the shards involved, sent over loopback to the owning worker (or run
+# directly for its own shard). each primitive is atomic on its shard and
+# never calls another shard, so workers cannot deadlock on each other.
+#
+# cohorts span shards: a cohort's members are found by asking every shard,
+# and new-cohort draws its members from the union of the shards' pools of
+# unassigned customers. cohort numbers are allocated per worker with a
+# stride of N, so they never collide.
+
+
+# shard owning a customer
+def shard_of(name, shards):
+    return zlib.crc32(name.encode()) % shards
+
+
+# per-shard variant of a database file name, customers.csv -> customers.0.csv
+def shard_file_name(filepath, shard):
+    root, ext = os.path.splitext(filepath)
+    return f"{root}.{shard}{ext}"
+
+
+class ShardedBank(Bank):
+
+    # the number of shards the database is split into
+    SHARDS_FILE_NAME = "shards.txt"
+
+    # worker i serves primitives on INTERNAL_IP, port INTERNAL_PORT - i
+    INTERNAL_IP = "127.0.0.1"
+    INTERNAL_PORT = Bank.PORT_END
+    RPC_TIMEOUT = 5
+
+    def __init__(self, shard, shards, sync_mode="fsync"):
+        if sync_mode == "group":
+            raise ValueError("group commit is not supported by the workers")
+
+        self.shard = shard
+        self.shards = shards
+        self.CUSTOMER_FILE_NAME = shard_file_name(Bank.CUSTOMER_FILE_NAME, shard)
+        self.COHORT_NUMBER_FILE_NAME = shard_file_name(
+            Bank.COHORT_NUMBER_FILE_NAME, shard)
+        self.JOURNAL_FILE_NAME = shard_file_name(Bank.JOURNAL_FILE_NAME, shard)
+        self.SNAPSHOT_FILE_NAME = shard_file_name(Bank.SNAPSHOT_FILE_NAME, shard)
+
+        super().__init__(sync_mode, reuse_port=True)
+
+        # guards the shard against the public and the internal thread
+        self.lock = threading.RLock()
+
+        self.internal_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.internal_sock.bind(
+            (ShardedBank.INTERNAL_IP, ShardedBank.INTERNAL_PORT - shard))
+
+        # socket used by this worker to call primitives on the other shards,
+        # replies are matched to calls with a sequence number
+        self.rpc_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rpc_sock.settimeout(ShardedBank.RPC_TIMEOUT)
+        self.rpc_seq = 0
+
+    def run(self):
+        threading.Thread(target=self.serve_internal, daemon=True).start()
+        super().run()
+
+    # answer the primitives sent by the other workers, dropping datagrams
+    # that are not "<seq> <primitive>"
+    def serve_internal(self):
+        while True:
+            data, addr = self.internal_sock.recvfrom(65535)
+            try:
+                seq, command = data.decode().split(' ', 1)
+                seq = int(seq)
+            except ValueError:
+                continue
+            response = self.primitive(command)
+            response["seq"] = seq
+            self.internal_sock.sendto(json.dumps(response).encode(), addr)
+
+    def commit(self, sync=True):
+        with self.lock:
+            return super().commit(sync)
+
+    # run a primitive on the given shard and return its response
+    def call(self, shard, command):
+        if shard == self.shard:
+            return self.primitive(command)
+
+        self.rpc_seq += 1
+        self.rpc_sock.sendto(f"{self.rpc_seq} {command}".encode(),
+                             (ShardedBank.INTERNAL_IP, ShardedBank.INTERNAL_PORT - shard))
+        while True:
+            # skip replies of earlier calls that timed out
+            response = json.loads(self.rpc_sock.recvfrom(65535)[0])
+            if response.pop("seq") == self.rpc_seq:
+                return response
+
+    # run a primitive on every shard and return the responses
+    def call_all(self, command):
+        return [self.call(shard, command) for shard in range(self.shards)]
+
+    # dissolve a cohort on every shard, going on past the shards that do
+    # not answer. returns whether every shard dissolved it
+    def dissolve(self, cohort):
+        dissolved = True
+        for shard in range(self.shards):
+            try:
+                self.call(shard, f"_dissolve {cohort}")
+            except (OSError, ValueError):
+                dissolved = False
+        return dissolved
+
+    # run a primitive on this shard and persist what it changed
+    def primitive(self, data):
+        with self.lock:
+            try:
+                response = self.run_primitive(data)
+            except Exception as e:
+                response = {"res": "FAILURE"}
+            self.commit()
+        return response
+
+    def run_primitive(self, data):
+        tokens = data.split()
+        command = tokens[0]
+
+        if command == "_open":
+            return Bank.open(self, data.split(' ', 1)[1], None)
+
+        if command == "_get":
+            c = self.customers.get(tokens[1])
+            if c is None:
+                return {"res": "FAILURE"}
+            return {"res": "SUCCESS", "data": c.row()}
+
+        if command == "_remove":
+            if tokens[1] not in self.customers:
+                return {"res": "FAILURE"}
+            self.customers.remove(tokens[1])
+            return {"res": "SUCCESS"}
+
+        if command == "_members":
+            return {"res": "SUCCESS",
+                    "data": [c.row() for c in self.customers.members(int(tokens[1]))]}
+
+        if command == "_dissolve":
+            self.customers.dissolve(int(tokens[1]))
+            return {"res": "SUCCESS"}
+
+        # number of customers, and of unassigned customers other than the given one
+        if command == "_count":
+            pool = len(self.customers.unassigned)
+            if tokens[1] in self.customers.unassigned:
+                pool -= 1
+            return {"res": "SUCCESS", "data": [len(self.customers), pool]}
+
+        # put a customer without a cohort into the given cohort
+        if command == "_assign":
+            c = self.customers.get(tokens[1])
+            if c is None or c.cohort != 0:
+                return {"res": "FAILURE"}
+            self.customers.assign(c, int(tokens[2]))
+            return {"res": "SUCCESS", "data": c.row()}
+
+        # the number of matches of a query on this shard, and a page of them
+        if command == "_query":
+            index, value, first, count = parse_query(data)
+            total, records = self.customers.query(index, value, first, count)
+            return {"res": "SUCCESS", "data": [c.row() for c in records], "total": total}
+
+        # put up to k random unassigned customers, other than the given one,
+        # into the given cohort
+        if command == "_claim":
+            cohort, k, exclude = int(tokens[1]), int(tokens[2]), tokens[3]
+            pool = self.customers.unassigned
+            available = len(pool) - (exclude in pool)
+            picked = pool.sample(min(k, available), exclude=exclude)
+            for c in picked:
+                self.customers.assign(c, cohort)
+            return {"res": "SUCCESS", "data": [c.row() for c in picked]}
+
+        return {"res": "FAILURE"}
+
+    # allocate a cohort number that no other worker will hand out
+    def next_cohort_number(self):
+        with self.lock:
+            cohort = self.cohort_number
+            self.cohort_number += self.shards
+            self.commit()
+        return cohort
+
+    def open(self, data, addr):
+        name = data.split(' ')[1]
+        return self.call(shard_of(name, self.shards), "_open " + data)
+
+    def get(self, data, addr):
+        request = parse_get(data)
+        if request is None:
+            return {"res": "FAILURE"}
+        customer, page = request
+
+        response = self.call(shard_of(customer, self.shards), f"_get {customer}")
+        if response["res"] != "SUCCESS":
+            return {"res": "FAILURE"}
+
+        # primitives send the customers as rows
+        c = CustomerRecord.from_row(response["data"])
+        members = [c]
+        if c.cohort != 0:
+            members = [CustomerRecord.from_row(member)
+                       for response in self.call_all(f"_members {c.cohort}")
+                       for member in response["data"]]
+
+        return get_response(c, members, page)
+
+    def delete_cohort(self, data, addr):
+        tokens = data.split()
+        if len(tokens) != 2:
+            return {"res": "FAILURE"}
+
+        command, customer = tokens
+        response = self.call(shard_of(customer, self.shards), f"_get {customer}")
+        if response["res"] != "SUCCESS" or response["data"][5] == 0:
+            return {"res": "FAILURE"}
+
+        # dissolving is idempotent, the customer can ask again if a shard
+        # did not answer
+        if not self.dissolve(response["data"][5]):
+            return {"res": "FAILURE", "reason": "shard unavailable"}
+        return {"res": "SUCCESS"}
+
+    def exit(self, data, addr):
+        tokens = data.split()
+        command, customer = tokens
+
+        # the customer stays, to exit again, until its cohort is dissolved
+        response = self.call(shard_of(customer, self.shards), f"_get {customer}")
+        if response["res"] != "SUCCESS":
+            return {"res": "FAILURE"}
+        if response["data"][5] != 0 and not self.dissolve(response["data"][5]):
+            return {"res": "FAILURE", "reason": "shard unavailable"}
+        return self.call(shard_of(customer, self.shards), f"_remove {customer}")
+
+    # cohort numbers are strided per worker, so a contiguous range of them
+    # cannot be handed out
+    def partition_cohorts(self, data, addr):
+        return {"res": "FAILURE", "reason": "not supported with several workers"}
+
+    # the matches of a query are those of shard 0, then shard 1... a page
+    # is taken from the shards it overlaps once their counts are known.
+    # the order by balance would take a merge of every shard up to the
+    # page, it is not supported
+    def query(self, data, addr):
+        request = parse_query(data)
+        if request is None:
+            return {"res": "FAILURE", "reason": "invalid query"}
+        index, value, first, count = request
+        if index == "balance-above":
+            return {"res": "FAILURE", "reason": "not supported with several workers"}
+
+        query = f"_query {index} {'' if value is None else value}"
+        totals = [response["total"] for response in self.call_all(f"{query} 0 1")]
+
+        rows = []
+        start = 0       # position of the shard's first match among all matches
+        for shard, total in enumerate(totals):
+            wanted = count - len(rows)
+            if wanted and start + total > first + len(rows):
+                offset = first + len(rows) - start
+                rows.extend(self.call(shard, f"{query} {offset} {wanted}")["data"])
+            start += total
+
+        return query_response(rows, sum(totals), first)
+
+    def new_cohort(self, data, addr):
+        tokens = data.split(' ')
+
+        command = tokens[0]
+        customer = tokens[1]
+        n = int(tokens[2])
+
+        if n < 2:
+            return {"res": "FAILURE"}
+
+        counts = [response["data"] for response in self.call_all(f"_count {customer}")]
+        if n > sum(total for total, pool in counts):
+            return {"res": "FAILURE"}
+
+        requester = self.call(shard_of(customer, self.shards), f"_get {customer}")
+        if requester["res"] == "SUCCESS" and requester["data"][5] != 0:
+            return {"res": "FAILURE"}
+
+        # pick n - 1 customers uniformly from the union of the pools,
+        # then work out how many come from each shard
+        pools = [pool for total, pool in counts]
+        if sum(pools) < n - 1:
+            return {"res": "FAILURE"}
+
+        wanted = [0] * self.shards
+        for index in random.sample(range(sum(pools)), n - 1):
+            shard = 0
+            while index >= pools[shard]:
+                index -= pools[shard]
+                shard += 1
+            wanted[shard] += 1
+
+        cohort = self.next_cohort_number()
+        res = []
+        complete = True
+
+        # whatever stops the claims half way, a refusal or a shard that does
+        # not answer, the members claimed so far are released
+        try:
+            if requester["res"] == "SUCCESS":
+                response = self.call(shard_of(customer, self.shards),
+                                     f"_assign {customer} {cohort}")
+                complete = response["res"] == "SUCCESS"
+                if complete:
+                    res.append(response["data"])
+
+            for shard, k in enumerate(wanted):
+                if k == 0 or not complete:
+                    continue
+                picked = self.call(shard, f"_claim {cohort} {k} {customer}")["data"]
+                res.extend(picked)
+                # another coordinator took some of this shard's pool meanwhile
+                complete = len(picked) == k
+        except Exception:
+            self.dissolve(cohort)
+            raise
+
+        if not complete:
+            self.dissolve(cohort)
+            return {"res": "FAILURE"}
+
+        return {
+            "res": "SUCCESS",
+            "data": res
+        }
+
+
+# split the single-process database into shards, unless it already is
+def split_database(shards):
+    if os.path.exists(ShardedBank.SHARDS_FILE_NAME):
+        with open(ShardedBank.SHARDS_FILE_NAME) as file:
+            split = int(file.read())
+        if split != shards:
+            raise ValueError(f"the database is split into {split} shards")
+        return
+
+    customers, cohort_number = load_database(JournalStorage(
+        Bank.SNAPSHOT_FILE_NAME, Bank.CUSTOMER_FILE_NAME, Bank.COHORT_NUMBER_FILE_NAME,
+        Bank.JOURNAL_FILE_NAME, Bank.JOURNAL_COMPACT_RECORDS))
+
+    parts = [[] for shard in range(shards)]
+    for c in customers:
+        parts[shard_of(c.name, shards)].append(c.fields())
+
+    for shard, rows in enumerate(parts):
+        # worker i hands out cohort numbers i, i + N, i + 2N... from here on
+        write_snapshot_file(rows, cohort_number + shard,
+                            shard_file_name(Bank.SNAPSHOT_FILE_NAME, shard))
+
+    with open(ShardedBank.SHARDS_FILE_NAME, 'w') as file:
+        file.write(str(shards))
+
+
+def run_worker(shard, shards, sync_mode, stats_file, stats_interval):
+    # a profile asked for while the shard loads is dropped, the bank only
+    # handles SIGUSR1 once it serves
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    bank = ShardedBank(shard, shards, sync_mode)
+    if stats_file:
+        bank.metrics.dump_periodically(shard_file_name(stats_file, shard), stats_interval)
+    bank.run()
+
+
+# run the bank as the given number of worker processes until they exit
+# each worker keeps its own stats, dumped to stats.<shard>.json for a
+# stats_file of stats.json
+def run_workers(shards, sync_mode="fsync", stats_file=None,
+                stats_interval=Bank.STATS_INTERVAL):
+    split_database(shards)
+
+    workers = [multiprocessing.Process(
+                   target=run_worker,
+                   args=(shard, shards, sync_mode, stats_file, stats_interval))
+               for shard in range(shards)]
+    for worker in workers:
+        worker.start()
+
+    # pass SIGUSR1 on, so that all the workers start a profile
+    def profile_workers(signum, frame):
+        for worker in workers:
+            os.kill(worker.pid, signal.SIGUSR1)
+
+    # take the workers down with the parent
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    signal.signal(signal.SIGUSR1, profile_workers)
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,119 @@
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+
+# binary snapshot of the bank's database
+# layout, little endian:
+#   header:  magic "BNKS", version (u16), padding (u16), number of customers
+#            (u32), number of distinct hosts (u32), cohort number (i64)
+#   columns: one fixed-width entry per customer in each of
+#            balance (i64), host (u32 index into the hosts), port1 (u16),
+#            port2 (u16), cohort (u32)
+#   string table: the hosts, then the names, utf-8 and each followed by a
+#            NUL byte
+# the customers and the cohort number live in the same file, so they are
+# replaced together. the file is memory-mapped and every column is decoded
+# in one go (array.frombytes, str.split), the columns are then zipped
+# into the fields of the customers without running python code per customer.
+
+MAGIC = b"BNKS"
+VERSION = 2
+
+HEADER = struct.Struct("<4sHHIIq")
+COLUMNS = (("balance", "q"), ("host", "I"), ("port1", "H"), ("port2", "H"),
+           ("cohort", "I"))
+
+# every port as an int object, shared by all the customers instead of one
+# int object per customer and port
+PORTS = list(range(65536))
+
+
+def column(typecode, values=()):
+    values = array(typecode, values)
+    # entries are 2, 4 or 8 bytes wide on every platform we run on
+    assert values.itemsize == struct.calcsize(typecode)
+    return values
+
+
+# write the customers' fields (CustomerRecord.fields()) and the cohort number
+# to a snapshot. raises ValueError, leaving the snapshot as it was, if a
+# field would not read back the same: out of the range of its column, or a
+# string holding a NUL
+def write_snapshot_file(rows, cohort_number, filepath):
+    hosts = {}
+    names = []
+    columns = {name: column(typecode) for name, typecode in COLUMNS}
+
+    try:
+        for name, balance, ipv4, port1, port2, cohort in rows:
+            names.append(name)
+            columns["balance"].append(balance)
+            columns["host"].append(hosts.setdefault(ipv4, len(hosts)))
+            columns["port1"].append(port1)
+            columns["port2"].append(port2)
+            columns["cohort"].append(cohort)
+        header = HEADER.pack(MAGIC, VERSION, 0, len(names), len(hosts), cohort_number)
+    except (OverflowError, struct.error) as e:
+        raise ValueError(f"field out of range for the snapshot of {names[-1:]}: {e}")
+    for strings in (hosts, names):
+        if "\0" in "".join(strings):
+            raise ValueError("string with a NUL in the snapshot")
+
+    # written next to the snapshot and then moved over it
+    with open(filepath + ".tmp", 'wb') as file:
+        file.write(header)
+        for name, typecode in COLUMNS:
+            if sys.byteorder == "big":
+                columns[name].byteswap()
+            file.write(columns[name].tobytes())
+        for strings in (hosts, names):
+            for string in strings:
+                file.write(string.encode() + b"\0")
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(filepath + ".tmp", filepath)
+
+
+# read a snapshot back, returns the customers' fields and the cohort number
+def read_snapshot_file(filepath):
+    with open(filepath, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise ValueError(f"{filepath} is empty")
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+            magic, version, padding, count, host_count, cohort_number = \
+                HEADER.unpack_from(snapshot, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{filepath} is not a version {VERSION} snapshot")
+
+            offset = HEADER.size
+            columns = {}
+            for name, typecode in COLUMNS:
+                values = column(typecode)
+                end = offset + count * values.itemsize
+                values.frombytes(snapshot[offset:end])
+                if sys.byteorder == "big":
+                    values.byteswap()
+                columns[name] = values
+                offset = end
+
+            strings = snapshot[offset:].decode().split("\0")
+
+    if len(strings) != host_count + count + 1:
+        raise ValueError(f"{filepath} is truncated")
+
+    # every customer on a host shares the same string
+    hosts = list(map(sys.intern, strings[:host_count]))
+    names = strings[host_count:host_count + count]
+
+    rows = list(zip(names,
+                    columns["balance"],
+                    map(hosts.__getitem__, columns["host"]),
+                    map(PORTS.__getitem__, columns["port1"]),
+                    map(PORTS.__getitem__, columns["port2"]),
+                    columns["cohort"]))
+
+    return rows, cohort_number
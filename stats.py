@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import socket
+import threading
+
+
+# latency histogram with power of two buckets
+# bucket i counts the durations of less than 2 ** i microseconds (and at
+# least 2 ** (i - 1)), so adding a duration is an int.bit_length() and an
+# increment, and percentiles are read back with the precision of a bucket
+class Histogram:
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * Histogram.BUCKETS
+
+    # add a duration in nanoseconds
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        self.buckets[min((ns // 1000).bit_length(), Histogram.BUCKETS - 1)] += 1
+
+    # upper bound, in microseconds, of the given fraction of the durations
+    def percentile(self, fraction):
+        wanted = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= wanted:
+                return 2 ** i
+        return 0
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count / 1000, 1),
+            "max_us": round(self.max / 1000, 1),
+            "p50_us": self.percentile(0.5),
+            "p99_us": self.percentile(0.99),
+            # upper bound in microseconds -> number of durations
+            "buckets": {2 ** i: n for i, n in enumerate(self.buckets) if n}
+        }
+
+
+# instrumentation of the bank's dispatch loop
+# every datagram is timed through the phases of PHASES and counted under
+# the command it carried, failures are counted by command and reason, and
+# the longer operations of the persistence path (group syncs, snapshots)
+# get a histogram of their own. recording is a few additions under a lock,
+# the summaries are only built when they are asked for.
+class Stats:
+
+    # parse: decoding and dispatch, handle: the command handler,
+    # persist: journal write and sync, send: encoding and sending the reply
+    PHASES = ("parse", "handle", "persist", "send")
+
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.started = time.monotonic()
+        # guards the counters against the periodic dump
+        self.lock = threading.Lock()
+
+        self.commands = {}      # command -> one Histogram per phase
+        self.operations = {}    # operation -> Histogram
+        self.errors = {}        # "command: reason" -> count
+        self.sources = {}       # name -> function returning a report of its own
+
+    # time one datagram, from the perf_counter_ns() timestamps taken at the
+    # start and at the end of each phase
+    def record(self, command, timestamps):
+        with self.lock:
+            phases = self.commands.get(command)
+            if phases is None:
+                phases = self.commands[command] = [Histogram() for phase in Stats.PHASES]
+            for i, histogram in enumerate(phases):
+                histogram.add(timestamps[i + 1] - timestamps[i])
+
+    def record_operation(self, operation, ns):
+        with self.lock:
+            histogram = self.operations.get(operation)
+            if histogram is None:
+                histogram = self.operations[operation] = Histogram()
+            histogram.add(ns)
+
+    def record_error(self, command, reason):
+        key = f"{command}: {reason}"
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    # add the report of another component (a cache...) under the given name
+    def include(self, name, report):
+        self.sources[name] = report
+
+    # everything recorded so far, as sent back by the "stats" command
+    def report(self):
+        uptime = time.monotonic() - self.started
+        with self.lock:
+            commands = {}
+            for command, phases in self.commands.items():
+                count = phases[0].count
+                commands[command] = {
+                    "count": count,
+                    "per_second": round(count / uptime, 2),
+                    "phases": {phase: histogram.summary()
+                               for phase, histogram in zip(Stats.PHASES, phases)}
+                }
+            operations = {operation: histogram.summary()
+                          for operation, histogram in self.operations.items()}
+            errors = dict(self.errors)
+
+        report = {
+            "uptime": round(uptime, 1),
+            "commands": commands,
+            "operations": operations,
+            "errors": errors,
+            "receive_queue": receive_queue(self.sock) if self.sock else None
+        }
+        for name, source in self.sources.items():
+            report[name] = source()
+        return report
+
+    # write the report to a file, replacing it at once
+    def dump(self, filepath):
+        with open(filepath + ".tmp", 'w') as file:
+            json.dump(self.report(), file, indent=1)
+        os.replace(filepath + ".tmp", filepath)
+
+    # dump the report every interval seconds from a background thread
+    def dump_periodically(self, filepath, interval):
+        def dump():
+            while True:
+                time.sleep(interval)
+                self.dump(filepath)
+
+        threading.Thread(target=dump, daemon=True).start()
+
+
+# state of a UDP socket's receive queue: the bytes waiting in it, the
+# datagrams dropped because it was full, and its size.
+# the queue is looked up in /proc/net/udp by the socket's inode, so this
+# only works on linux and returns None elsewhere
+def receive_queue(sock):
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    for table in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(table) as file:
+                lines = file.readlines()[1:]
+        except OSError:
+            continue
+
+        # sl local_address rem_address st tx_queue:rx_queue tr:tm->when
+        # retrnsmt uid timeout inode ref pointer drops
+        for line in lines:
+            fields = line.split()
+            if fields[9] == inode:
+                return {
+                    "bytes": int(fields[4].split(":")[1], 16),
+                    "drops": int(fields[12]),
+                    "buffer": buffer
+                }
+    return None
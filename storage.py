@@ -0,0 +1,355 @@
+import os
+import csv
+import sys
+import sqlite3
+import time
+import threading
+import functools
+from ipaddress import ip_address, IPv4Address
+
+from journal import Journal
+from snapshot import PORTS, read_snapshot_file
+
+
+# storage backends of the bank
+# the bank serves from memory (CustomerRegistry) and hands its backend the
+# records of the mutations of every command: the records of
+# CustomerRegistry.apply(), and ["next", <cohort number>] when the cohort
+# counter moves. a backend provides:
+#   load()          the customers stored, as typed rows (see typed_row()),
+#                   the cohort number, and records to redo on top of them
+#   open(snapshot)  start taking records, once the load is done. snapshot
+#                   is Bank.snapshot(), for the backends writing the whole
+#                   state at times
+#   write(records)  store the records of one commit, all of them or none,
+#                   durable after the next sync()
+#   sync()          make every record written so far durable
+#   dirty           whether records were written since the last sync()
+#   sync_periodically(interval)
+#                   sync() every interval seconds from a background thread
+#   maintain(size)  housekeeping after a commit, size is the number of
+#                   customers
+#   close()
+# the customers and the cohort number written by one commit are stored
+# together by every backend. databases start from customers.csv and
+# cohort_number.txt.
+
+
+# open a new csv file, acting as a database
+
+
+def read_csv_file(filepath):
+    data = []
+
+    with open(filepath) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        line_count = 0
+        for row in csv_reader:
+            if line_count == 0:
+                line_count += 1
+            else:
+                data.append(row)
+                line_count += 1
+    return data
+
+# open a text file  to read current cohort number
+
+
+def read_cohort_number(filepath):
+    with open(filepath) as cohort_file:
+        return int(cohort_file.read())
+
+
+# write a list of customers information to the csv database
+# the file is written next to the database and then moved over it,
+# so a crash never leaves a truncated database behind
+def write_customers_file(li, filepath):
+    with open(filepath + ".tmp", mode='w', newline='') as file:
+        writer = csv.writer(file, delimiter=',',
+                            quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['Customer', 'Balance',
+                        'IPv4 Address', '`Port1`', 'Port2', 'Cohort'])
+
+        for each in li:
+            writer.writerow(each)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(filepath + ".tmp", filepath)
+
+# write the current cohort number
+
+
+def write_cohort_number(number, filepath):
+    with open(filepath + ".tmp", 'w') as file:
+        file.write(str(number))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(filepath + ".tmp", filepath)
+
+
+# check if address field in the command is in correct ipv4 format
+# customers share a few hosts, the answers for the recent ones are kept
+@functools.lru_cache(maxsize=1024)
+def validIP(address: str) -> bool:
+    try:
+        return True if type(ip_address(address)) is IPv4Address else False
+    except ValueError:
+        return False
+
+
+# check the fields of a new customer: name, balance, ipv4, port1, port2
+def valid_customer(tokens):
+    if len(tokens) < 5:
+        return False
+
+    name, balance, address, server_port, client_port = tokens[:5]
+
+    # names are single tokens of the text commands, and NUL-terminated
+    # strings of the snapshot: no control characters
+    if len(name.split()) != 1 or len(name) > 15 or not name.isprintable():
+        return False
+
+    # ports are stored as 16 bit integers in the snapshot
+    for port in (server_port, client_port):
+        if not port.isdigit() or int(port) > 65535:
+            return False
+
+    # balances are stored as 64 bit integers
+    if not balance.isdigit() or int(balance) >= 2 ** 63:
+        return False
+
+    # if there are more than one customer in the same host, check if they are using different port number
+    return server_port != client_port and validIP(address)
+
+
+# the typed fields of a row in the customers.csv layout, the cohort is
+# optional. hosts and ports are the shared objects of CustomerRecord
+def typed_row(row):
+    return (row[0], int(row[1]), sys.intern(row[2]),
+            PORTS[int(row[3])], PORTS[int(row[4])],
+            int(row[5]) if len(row) > 5 else 0)
+
+
+# the customers and the cohort number of the csv files
+# rows that "open" would refuse, or with a cohort that is not a number,
+# are skipped and reported rather than stop the bank from starting
+def load_csv(customers_file, cohort_number_file):
+    rows = []
+    # the header is line 1
+    for line, row in enumerate(read_csv_file(customers_file), 2):
+        if not valid_customer(row) or (len(row) > 5 and not (
+                row[5].isdigit() and int(row[5]) < 2 ** 32)):
+            print(f"{customers_file}:{line}: skipping invalid customer {row}",
+                  file=sys.stderr)
+            continue
+        rows.append(typed_row(row))
+    return rows, read_cohort_number(cohort_number_file)
+
+
+# binary snapshot (see snapshot.py) and journal of the mutations written
+# since (see journal.py). the snapshot is loaded from the csv files until
+# the first one is written. the journal is folded into a new snapshot
+# once it holds compact_records records, or as many as there are
+# customers if that is more
+class JournalStorage:
+
+    def __init__(self, snapshot_file, customers_file, cohort_number_file, journal_file,
+                 compact_records):
+        self.snapshot_file = snapshot_file
+        self.customers_file = customers_file
+        self.cohort_number_file = cohort_number_file
+        self.journal = Journal(journal_file)
+        self.compact_records = compact_records
+        self.snapshot = None
+
+    def load(self):
+        if os.path.exists(self.snapshot_file):
+            rows, cohort_number = read_snapshot_file(self.snapshot_file)
+        else:
+            rows, cohort_number = load_csv(self.customers_file, self.cohort_number_file)
+        return rows, cohort_number, self.journal.replay()
+
+    # a replayed journal is folded into a snapshot straight away
+    def open(self, snapshot):
+        self.snapshot = snapshot
+        self.journal.open()
+        if self.journal.records:
+            self.journal.checkpoint(snapshot)
+
+    @property
+    def dirty(self):
+        return self.journal.dirty
+
+    def write(self, records):
+        self.journal.write(records)
+
+    def sync(self):
+        self.journal.sync()
+
+    def sync_periodically(self, interval):
+        self.journal.sync_periodically(interval)
+
+    def maintain(self, size):
+        if self.journal.records >= max(self.compact_records, size):
+            self.journal.compact(self.snapshot)
+
+    def close(self):
+        self.journal.close()
+
+
+# SQLite database in WAL mode, with a customers table indexed on name and
+# cohort and a meta table for the cohort number. every record updates the
+# rows it names, nothing is rewritten as a whole.
+# records are queued by write() and applied by sync() in one transaction,
+# with synchronous=FULL so that the commit is on disk when it returns: the
+# records of one commit, the cohort number with them, are stored or lost
+# together, and in group commit mode a whole group shares one transaction.
+# the database is seeded from the csv files when it is created.
+class SQLiteStorage:
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS customers (name TEXT PRIMARY KEY, "
+        "balance INTEGER NOT NULL, ipv4 TEXT NOT NULL, port1 INTEGER NOT NULL, "
+        "port2 INTEGER NOT NULL, cohort INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS customers_cohort ON customers (cohort)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    )
+
+    def __init__(self, filepath, customers_file, cohort_number_file):
+        self.filepath = filepath
+        self.customers_file = customers_file
+        self.cohort_number_file = cohort_number_file
+
+        self.connection = None
+        # records written since the last sync. writers only queue them under
+        # the lock; the connection belongs to sync(), which applies and
+        # commits them outside of it, so writers never wait on the disk
+        self.pending = []
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+    def load(self):
+        # transactions are begun and committed by hand
+        self.connection = sqlite3.connect(self.filepath, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+
+        # the schema and the seed go in at once, a crash in between leaves
+        # no half-seeded database
+        self.connection.execute("BEGIN IMMEDIATE")
+        for statement in SQLiteStorage.SCHEMA:
+            self.connection.execute(statement)
+        if self.cohort_number() is None:
+            rows, cohort_number = load_csv(self.customers_file, self.cohort_number_file)
+            self.connection.executemany(
+                "INSERT INTO customers VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute(
+                "INSERT INTO meta VALUES ('cohort_number', ?)", (cohort_number,))
+        self.connection.execute("COMMIT")
+
+        # in registration order, which a replaced row goes to the end of
+        rows = [(name, balance, sys.intern(ipv4), PORTS[port1], PORTS[port2], cohort)
+                for name, balance, ipv4, port1, port2, cohort in self.connection.execute(
+                    "SELECT * FROM customers ORDER BY rowid")]
+        return rows, self.cohort_number(), []
+
+    def cohort_number(self):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'cohort_number'").fetchone()
+        return row and row[0]
+
+    def open(self, snapshot):
+        pass
+
+    @property
+    def dirty(self):
+        return bool(self.pending)
+
+    def write(self, records):
+        with self.lock:
+            self.pending.extend(records)
+
+    def apply(self, record):
+        if record[0] == "put":
+            self.connection.execute("INSERT OR REPLACE INTO customers VALUES (?, ?, ?, ?, ?, ?)",
+                                    typed_row(record[1]))
+        elif record[0] == "del":
+            self.connection.execute("DELETE FROM customers WHERE name = ?", (record[1],))
+        elif record[0] == "cohort":
+            self.connection.executemany("UPDATE customers SET cohort = ? WHERE name = ?",
+                                        [(record[1], name) for name in record[2]])
+        elif record[0] == "next":
+            self.connection.execute(
+                "UPDATE meta SET value = ? WHERE key = 'cohort_number'", (record[1],))
+
+    def sync(self):
+        with self.sync_lock:
+            with self.lock:
+                records, self.pending = self.pending, []
+            if not records:
+                return
+
+            self.connection.execute("BEGIN")
+            try:
+                for record in records:
+                    self.apply(record)
+                self.connection.execute("COMMIT")
+            except Exception:
+                # the records are queued again, ahead of the newer ones
+                self.connection.execute("ROLLBACK")
+                with self.lock:
+                    self.pending[:0] = records
+                raise
+
+    def sync_periodically(self, interval):
+        def helper():
+            while True:
+                time.sleep(interval)
+                self.sync()
+
+        threading.Thread(target=helper, daemon=True).start()
+
+    # SQLite checkpoints its WAL into the database by itself
+    def maintain(self, size):
+        pass
+
+    def close(self):
+        self.sync()
+        self.connection.close()
+
+
+# nothing is stored: the database is loaded from the csv files if they
+# exist, and the mutations only live as long as the process. for tests and
+# benchmarks of everything but the storage
+class MemoryStorage:
+
+    dirty = False
+
+    def __init__(self, customers_file, cohort_number_file):
+        self.customers_file = customers_file
+        self.cohort_number_file = cohort_number_file
+
+    def load(self):
+        if not os.path.exists(self.customers_file):
+            return [], 1, []
+        rows, cohort_number = load_csv(self.customers_file, self.cohort_number_file)
+        return rows, cohort_number, []
+
+    def open(self, snapshot):
+        pass
+
+    def write(self, records):
+        pass
+
+    def sync(self):
+        pass
+
+    def sync_periodically(self, interval):
+        pass
+
+    def maintain(self, size):
+        pass
+
+    def close(self):
+        pass
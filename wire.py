@@ -0,0 +1,277 @@
+import json
+import uuid
+import socket
+import struct
+
+
+# compact binary encoding of the bank's and the customers' commands
+# a binary message starts with MAGIC, a byte no text command starts with,
+# then the version and the opcode of its command. the fields follow,
+# packed: integers at fixed width, strings as a length byte and utf-8,
+# IPv4 addresses as 4 bytes and checkpoint/rollback ids as 16 bytes.
+# a response starts with the same header (the opcode of its request) and a
+# status: SUCCESS or FAILURE with a reason, a body packed for its command
+# (get, new-cohort), or JSON for whatever does not fit those shapes.
+#
+# a request with an id ("req <id> <command>" in text, see Bank.decode())
+# is the REQUEST_ID header, the id and then the binary command; its
+# response is the REQUEST_ID header, the id and the binary response.
+#
+# binary messages are decoded back into the text command they stand for,
+# so the handlers and their checks are the same for both encodings, and
+# are answered in the encoding they came in. a client only sends binary
+# to a peer that answered "hello" with the version it uses, and sends text
+# to any other, see Customer.send().
+
+MAGIC = b"\xb1"
+VERSION = 1
+VERSIONS = [1]
+
+HEADER = struct.Struct("<cBB")
+STATUS = struct.Struct("<B")
+SUCCESS, FAILURE, JSON = 0, 1, 2
+
+# opcode of the header of a request with an id, and of its response
+REQUEST_ID = 0x80
+ID = struct.Struct("<Q")
+
+# command -> opcode, and the fields of the command after its name:
+#   s string, q 64 bit integer, H 16 bit integer, 4 IPv4 address, u id
+COMMANDS = {
+    "open": (1, "sq4HH"),
+    "new-cohort": (2, "sH"),
+    "delete-cohort": (3, "s"),
+    "exit": (4, "s"),
+    "get": (5, "s"),
+    "transfer": (16, "qsqs"),
+    "take-a-tentative-checkpoint": (17, "squ"),
+    "make-tentative-checkpoint-permanent": (18, "u"),
+    "undo-tentative-checkpoint": (19, "u"),
+    "prepare-to-rollback": (20, "squ"),
+    "send-rollback": (21, "u"),
+    "do-not-rollback": (22, "u"),
+}
+OPCODES = {opcode: (command, fields) for command, (opcode, fields) in COMMANDS.items()}
+
+INTEGERS = {"q": struct.Struct("<q"), "H": struct.Struct("<H")}
+GET = struct.Struct("<Bq")              # status, balance of a get response
+MEMBER = struct.Struct("<4sH")          # ipv4, port2 of a get response
+ROW = struct.Struct("<q4sHHI")          # balance, ipv4, port1, port2, cohort
+
+
+def is_binary(data):
+    return data[:1] == MAGIC
+
+
+def pack_string(value):
+    value = value.encode()
+    if len(value) > 255:
+        raise ValueError("string too long")
+    return bytes((len(value),)) + value
+
+
+def pack_ipv4(value):
+    packed = socket.inet_aton(value)
+    # inet_aton also takes shorthands like "10.1", which would not read back the same
+    if socket.inet_ntoa(packed) != value:
+        raise ValueError(f"not a dotted IPv4 address: {value}")
+    return packed
+
+
+# pack a field of a text command. fields that would not decode back to
+# the same text ("007", an id in braces...) are refused
+def pack_field(kind, value):
+    if kind == "s":
+        return pack_string(value)
+    if kind == "4":
+        return pack_ipv4(value)
+    if kind == "u":
+        packed = uuid.UUID(value)
+        if str(packed) != value:
+            raise ValueError(f"not a canonical id: {value}")
+        return packed.bytes
+    if str(int(value)) != value:
+        raise ValueError(f"not a canonical integer: {value}")
+    return INTEGERS[kind].pack(int(value))
+
+
+# reads fields one after the other from a message
+class Reader:
+
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = offset
+
+    def string(self):
+        end = self.offset + 1 + self.data[self.offset]
+        if end > len(self.data):
+            raise ValueError("truncated message")
+        value = self.data[self.offset + 1:end].decode()
+        self.offset = end
+        return value
+
+    def unpack(self, layout):
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+    def field(self, kind):
+        if kind == "s":
+            return self.string()
+        if kind == "4":
+            return self.ipv4()
+        if kind == "u":
+            value = self.data[self.offset:self.offset + 16]
+            self.offset += 16
+            return str(uuid.UUID(bytes=value))
+        return str(self.unpack(INTEGERS[kind])[0])
+
+    def ipv4(self):
+        value = self.data[self.offset:self.offset + 4]
+        if len(value) != 4:
+            raise ValueError("truncated message")
+        self.offset += 4
+        return socket.inet_ntoa(value)
+
+
+# encode a text command, None if it has no binary form (unknown command,
+# fields that do not fit their binary type): it is then sent as text
+def encode_request(text):
+    if text.startswith("req "):
+        tokens = text.split(' ', 2)
+        if len(tokens) != 3 or not tokens[1].isdigit() or int(tokens[1]) >= 2 ** 64:
+            return None
+        message = encode_request(tokens[2])
+        if message is None:
+            return None
+        return HEADER.pack(MAGIC, VERSION, REQUEST_ID) + ID.pack(int(tokens[1])) + message
+
+    tokens = text.split(' ')
+    if tokens[0] not in COMMANDS:
+        return None
+    opcode, fields = COMMANDS[tokens[0]]
+    if len(tokens) != len(fields) + 1:
+        return None
+
+    try:
+        return HEADER.pack(MAGIC, VERSION, opcode) + b"".join(
+            pack_field(kind, value) for kind, value in zip(fields, tokens[1:]))
+    except (ValueError, struct.error, OSError):
+        return None
+
+
+# decode a binary command, returns the name of the command and the text
+# command it stands for. raises ValueError if the message is malformed
+def decode_request(data):
+    try:
+        magic, version, opcode = HEADER.unpack_from(data, 0)
+        if opcode == REQUEST_ID and version in VERSIONS:
+            rid, = ID.unpack_from(data, HEADER.size)
+            command, text = decode_request(data[HEADER.size + ID.size:])
+            return command, f"req {rid} {text}"
+        command, fields = OPCODES[opcode]
+        reader = Reader(data, HEADER.size)
+        text = " ".join([command] + [reader.field(kind) for kind in fields])
+    except (KeyError, IndexError, struct.error, UnicodeDecodeError, OSError) as e:
+        raise ValueError(f"malformed message: {e}")
+    if version not in VERSIONS:
+        raise ValueError(f"unknown version {version}")
+    return command, text
+
+
+# encode the response to a binary command, of the request with the id rid
+# if it had one. the addresses in responses are those the bank checked
+# when the customer opened, so they are packed without pack_ipv4()'s
+# round trip
+def encode_response(command, response, rid=None):
+    opcode = COMMANDS[command][0] if command in COMMANDS else 0
+    header = HEADER.pack(MAGIC, VERSION, opcode)
+    if rid is not None:
+        header = HEADER.pack(MAGIC, VERSION, REQUEST_ID) + ID.pack(rid) + header
+    try:
+        return header + encode_body(command, response)
+    except (ValueError, KeyError, TypeError, struct.error, OSError):
+        return header + STATUS.pack(JSON) + json.dumps(response).encode()
+
+
+def encode_body(command, response):
+    keys = response.keys()
+    if response["res"] == "FAILURE" and keys <= {"res", "reason"}:
+        return STATUS.pack(FAILURE) + pack_string(response.get("reason", ""))
+
+    if response["res"] != "SUCCESS":
+        raise ValueError("not a plain response")
+    if keys == {"res"}:
+        return STATUS.pack(SUCCESS)
+
+    if command == "get" and keys == {"res", "data"}:
+        data = response["data"]
+        parts = [GET.pack(SUCCESS, int(data["balance"])), pack_string(data["name"]),
+                 INTEGERS["H"].pack(len(data["cohort"]))]
+        for member in data["cohort"]:
+            parts += (pack_string(member["name"]),
+                      MEMBER.pack(socket.inet_aton(member["ipv4"]), int(member["port2"])))
+        return b"".join(parts)
+
+    if command == "new-cohort" and keys == {"res", "data"}:
+        rows = response["data"]
+        parts = [STATUS.pack(SUCCESS), INTEGERS["H"].pack(len(rows))]
+        for name, balance, ipv4, port1, port2, cohort in rows:
+            parts.append(pack_string(name))
+            parts.append(ROW.pack(int(balance), socket.inet_aton(ipv4), int(port1), int(port2),
+                                  cohort))
+        return b"".join(parts)
+
+    raise ValueError("no binary form")
+
+
+# decode the response to a binary command into the dict the text
+# protocol would have answered, with "id" for a request with an id
+def decode_response(data):
+    magic, version, opcode = HEADER.unpack_from(data, 0)
+    if opcode == REQUEST_ID:
+        rid, = ID.unpack_from(data, HEADER.size)
+        response = decode_response(data[HEADER.size + ID.size:])
+        response["id"] = rid
+        return response
+
+    command = OPCODES[opcode][0] if opcode in OPCODES else None
+    status = data[HEADER.size]
+    reader = Reader(data, HEADER.size + 1)
+
+    if status == JSON:
+        return json.loads(data[reader.offset:])
+    if status == FAILURE:
+        reason = reader.string()
+        return {"res": "FAILURE", "reason": reason} if reason else {"res": "FAILURE"}
+    if reader.offset == len(data):
+        return {"res": "SUCCESS"}
+
+    if command == "get":
+        balance, = reader.unpack(INTEGERS["q"])
+        name = reader.string()
+        count, = reader.unpack(INTEGERS["H"])
+        # the members are read in place, this is the hot path of the clients
+        cohort = []
+        offset = reader.offset
+        for i in range(count):
+            end = offset + 1 + data[offset]
+            ipv4, port2 = MEMBER.unpack_from(data, end)
+            cohort.append({"name": data[offset + 1:end].decode(),
+                           "ipv4": socket.inet_ntoa(ipv4), "port2": str(port2)})
+            offset = end + MEMBER.size
+        if offset != len(data):
+            raise ValueError("malformed response")
+        return {"res": "SUCCESS", "data": {"balance": str(balance), "cohort": cohort, "name": name}}
+
+    if command == "new-cohort":
+        count, = reader.unpack(INTEGERS["H"])
+        rows = []
+        for i in range(count):
+            name = reader.string()
+            balance, ipv4, port1, port2, cohort = reader.unpack(ROW)
+            rows.append([name, str(balance), socket.inet_ntoa(ipv4), str(port1), str(port2),
+                         cohort])
+        return {"res": "SUCCESS", "data": rows}
+
+    raise ValueError("malformed response")